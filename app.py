@@ -1,7 +1,18 @@
 # app.py - Main Flask application file
-# Handles routing, chart generation, and scheduled updates
-
-from flask import Flask, render_template, redirect, url_for, request, flash
+# Handles routing, chart generation, and live updates of data the worker writes
+
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    make_response,
+    render_template,
+    redirect,
+    url_for,
+    request,
+    session,
+    flash,
+)
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -11,21 +22,34 @@ from flask_login import (
     current_user,
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime, timedelta, time
+from werkzeug.http import is_resource_modified
+from datetime import datetime, timedelta, time, timezone
 from dateutil.relativedelta import relativedelta
-import plotly
-import plotly.graph_objs as go
+import hashlib
 import json
+import os
+import numpy as np
 from database import (
     create_connection,
-    update_current_stock_data,
-    update_intraday_price_history,
-    update_current_month_data,
     process_transaction,
-    update_all_portfolios,
+    get_portfolio,
+    get_price_series,
+    get_data_versions,
+)
+from chart_cache import chart_cache
+from live_updates import live_updates
+from symbol_loader import symbol_loader
+from symbol_registry import record_view
+from version_watcher import version_watcher
+from downsampling import downsample
+from chart_json import line_chart_json
+from stock_data import (
+    datetime_to_epoch,
+    date_to_epoch,
+    timestamp_to_epoch,
+    MARKET_OPEN_MINUTE,
+    MARKET_CLOSE_MINUTE,
 )
-from setup import update_daily_price_history
 import secrets
 
 # Initialize Flask application
@@ -37,6 +61,25 @@ login_manager.init_app(app)
 login_manager.login_view = "login"
 
 
+def get_template_version():
+    """Hash the templates and static files that responses are rendered from"""
+    digest = hashlib.sha1()
+    for folder in (app.template_folder, app.static_folder):
+        root = os.path.join(app.root_path, folder)
+        for directory, _, files in sorted(os.walk(root)):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                digest.update(os.path.relpath(path, root).encode())
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+    return digest.hexdigest()
+
+
+# Version of the templates and static files, part of every ETag so a deploy
+# that changes them does not answer 304 for pages rendered by the old ones
+TEMPLATE_VERSION = get_template_version()
+
+
 class User(UserMixin):
     def __init__(self, id, username):
         self.id = id
@@ -59,6 +102,12 @@ def load_user(user_id):
     return User.get(user_id)
 
 
+@app.before_request
+def start_version_watcher():
+    """Keep caches and live updates in step with writes from the ingest worker"""
+    version_watcher.start()
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
@@ -92,6 +141,7 @@ def register():
         user = cursor.fetchone()
 
         if user:
+            connection.close()
             flash("Username already exists")
             return redirect(url_for("register"))
         hashed_password = generate_password_hash(password)
@@ -113,9 +163,80 @@ def logout():
     return redirect(url_for("index"))
 
 
+def get_market_state():
+    """Return the trading date and whether the market is open, which chart
+    windows depend on"""
+    now = datetime.now()
+    return (now.strftime("%Y-%m-%d"), time(9, 30) <= now.time() <= time(16, 0))
+
+
+def get_validators(scopes, *parts, holdings_user_id=None):
+    """
+    Build the ETag and Last-Modified of a response from the data it shows.
+
+    The ETag changes whenever any of the data_versions scopes is written,
+    and also covers TEMPLATE_VERSION, so it is the same in every web process
+    and across restarts until the templates change.
+
+    Args:
+        scopes: data_versions scopes the response is built from
+        *parts: Anything else the response depends on (period, user, ...)
+        holdings_user_id: Optional user ID whose holdings' quotes are shown
+
+    Returns:
+        Tuple of (ETag string, Last-Modified datetime or None)
+    """
+    versions, updated_at = get_data_versions(scopes, holdings_user_id)
+    key = repr((TEMPLATE_VERSION, parts, versions))
+    etag = hashlib.sha1(key.encode()).hexdigest()
+
+    last_modified = None
+    if updated_at is not None:
+        last_modified = datetime.fromtimestamp(updated_at, timezone.utc)
+    return etag, last_modified
+
+
+def conditional_response(render, etag, last_modified, public=False):
+    """
+    Answer a GET with 304 Not Modified when the client's copy is current.
+
+    Only the ETag is used to decide: the responses also depend on the user
+    and the time of day, which Last-Modified does not capture. Responses
+    are marked no-cache, so browsers revalidate on every use instead of
+    showing data from before the last refresh.
+
+    Args:
+        render: Function returning the response body when it is needed
+        etag: ETag of the current content
+        last_modified: Time the underlying data last changed, or None
+        public: Whether shared caches may store the response
+
+    Returns:
+        Flask response
+    """
+    # Pages showing flashed messages are one-off, render them without validators
+    if session.get("_flashes"):
+        return make_response(render())
+
+    if is_resource_modified(request.environ, etag=etag):
+        response = make_response(render())
+        response.last_modified = last_modified
+    else:
+        response = Response(status=304)
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    return response
+
+
 def get_stock_chart_data(symbol, period):
     """
-    Generate chart data for a given stock symbol and time period.
+    Get chart JSON for a symbol and period, served from the chart cache when
+    no new bars were stored for the symbol since it was built.
 
     Args:
         symbol: Stock ticker symbol (e.g., 'AAPL')
@@ -124,7 +245,34 @@ def get_stock_chart_data(symbol, period):
     Returns:
         JSON string containing chart data and layout configuration
     """
-    connection, cursor = create_connection()
+    # Chart windows depend on the date and, for 1 day, on market hours
+    market_state = get_market_state()
+
+    stock_chart_json = chart_cache.get(symbol, period, market_state)
+    if stock_chart_json is None:
+        generation = chart_cache.generation(symbol)
+        stock_chart_json = build_stock_chart_data(symbol, period)
+        chart_cache.put(symbol, period, market_state, stock_chart_json, generation)
+
+    return stock_chart_json
+
+
+def get_chart_series(symbol, period, since_ts=None):
+    """
+    Get the points plotted for a stock symbol and time period.
+
+    Served from the in-memory price series, so no SQL runs once the symbol
+    is loaded.
+
+    Args:
+        symbol: Stock ticker symbol (e.g., 'AAPL')
+        period: Time period for chart ('1day', '1week', '1mo', '3mo', '6mo', '1y', '5y')
+        since_ts: Optional epoch seconds, only points at or after it are returned
+
+    Returns:
+        Tuple of (epoch seconds, price) NumPy arrays in time order
+    """
+    series = get_price_series(symbol)
 
     # Calculate date range based on selected period
     end_date = datetime.now()
@@ -136,37 +284,23 @@ def get_stock_chart_data(symbol, period):
         current_time = now.time()
         market_open = time(9, 30)  # Market opens at 9:30 AM EST
         market_close = time(16, 0)  # Market closes at 4:00 PM EST
-        start_date = end_date - timedelta(days=1)
         interval = 1  # 1-minute intervals
 
         # Handle market hours logic
         if current_time < market_open or current_time > market_close:
-            query = """
-                SELECT timestamp, price
-                FROM price_history
-                WHERE stock_symbol = ?
-                AND date(timestamp) = (
-                    SELECT date(timestamp) 
-                    FROM price_history 
-                    WHERE substr(timestamp, 12, 8) >= '09:30:00' AND substr(timestamp, 12, 8) <= '16:00:00'
-                    ORDER BY timestamp DESC 
-                    LIMIT 1
-                )
-                AND substr(timestamp, 12, 8) >= '09:30:00' AND substr(timestamp, 12, 8) <= '16:00:00'
-                ORDER BY timestamp ASC
-            """
-            params = (symbol,)
+            # Show the most recent session that has regular-hours data,
+            # searching only the last week of bars
+            session_start = 0
+            if len(series):
+                last_ts = series.ts[-1]
+                recent = series.between(last_ts - 7 * 86400, last_ts).market_hours()
+                if len(recent):
+                    session_start = recent.ts[-1] - recent.ts[-1] % 86400
         else:
-            today = now.strftime("%Y-%m-%d")
-            query = """
-                SELECT timestamp, price
-                FROM price_history
-                WHERE stock_symbol = ?
-                AND date(timestamp) = ?
-                AND substr(timestamp, 12, 8) >= '09:30:00' AND substr(timestamp, 12, 8) <= '16:00:00'
-                ORDER BY timestamp ASC
-            """
-            params = (symbol, today)
+            session_start = date_to_epoch(now.strftime("%Y-%m-%d"))
+
+        range_start = session_start + MARKET_OPEN_MINUTE * 60
+        range_end = session_start + MARKET_CLOSE_MINUTE * 60
     elif period == "1mo":
         start_date = end_date - relativedelta(months=1)
         interval = 15  # 15-minute intervals
@@ -178,102 +312,85 @@ def get_stock_chart_data(symbol, period):
         interval = 60  # 60-minute intervals
     elif period == "1y":
         start_date = end_date - relativedelta(years=1)
-        interval = 240  # 4-hour intervals
+        interval = 60  # Hourly intervals, downsampled to the point budget
     else:  # 5y
         start_date = end_date - relativedelta(years=5)
+        interval = 1440  # Daily intervals
 
-    # Build query based on period
     if period != "1day":
-        if period == "5y":
-            # For 5-year view, use daily closing prices
-            query = """
-                SELECT timestamp, price
-                FROM price_history
-                WHERE stock_symbol = ?
-                AND timestamp BETWEEN ? AND ?
-                AND substr(timestamp, 12, 8) = '16:00:00'
-                GROUP BY date(timestamp)
-                ORDER BY timestamp ASC
-            """
-            params = (
-                symbol,
-                start_date.strftime("%Y-%m-%d %H:%M:%S"),
-                end_date.strftime("%Y-%m-%d %H:%M:%S"),
-            )
-        else:
-            # For other periods, group by interval
-            query = """
-                SELECT timestamp, price
-                FROM price_history
-                WHERE stock_symbol = ?
-                AND timestamp BETWEEN ? AND ?
-                AND substr(timestamp, 12, 8) >= '09:30:00' AND substr(timestamp, 12, 8) <= '16:00:00'
-                GROUP BY strftime('%s', timestamp) / (? * 60)
-                ORDER BY timestamp ASC
-            """
-            params = (
-                symbol,
-                start_date.strftime("%Y-%m-%d %H:%M:%S"),
-                end_date.strftime("%Y-%m-%d %H:%M:%S"),
-                interval,
-            )
-
-    # Execute query and fetch data
-    cursor.execute(query, params)
-    chart_data = cursor.fetchall()
-    connection.close()
+        # Start at the first whole bucket inside the window
+        span = interval * 60
+        range_start = datetime_to_epoch(start_date)
+        range_start += -range_start % span
+        range_end = datetime_to_epoch(end_date)
+
+    # Deltas only need the points from the last one the client has onward
+    if since_ts is not None:
+        range_start = max(range_start, since_ts)
+
+    # Longer periods aggregate the bars into buckets and plot the closing prices
+    points = series.between(range_start, range_end)
+    if period != "1day":
+        points = points.resample(interval)
+    return points.ts, points.close
+
+
+def format_chart_times(ts_values):
+    """Format epoch seconds as the 'YYYY-MM-DD HH:MM:SS' strings plotted on charts"""
+    # np.char cannot operate on empty arrays
+    if not len(ts_values):
+        return []
+    times = np.datetime_as_string(np.asarray(ts_values, dtype="datetime64[s]"))
+    return np.char.replace(times, "T", " ").tolist()
+
+
+def build_stock_chart_data(symbol, period):
+    """
+    Generate chart data for a given stock symbol and time period.
+
+    Args:
+        symbol: Stock ticker symbol (e.g., 'AAPL')
+        period: Time period for chart ('1day', '1week', '1mo', '3mo', '6mo', '1y', '5y')
+
+    Returns:
+        JSON string containing chart data and layout configuration
+    """
+    now = datetime.now()
+    ts_values, prices = get_chart_series(symbol, period)
 
     # Handle no data case
-    if not chart_data:
+    if not len(ts_values):
         return json.dumps(
             {"data": [], "layout": {"title": f"No data available for {symbol}"}}
         )
 
-    # Create Plotly trace
-    trace = go.Scatter(
-        x=[row[0] for row in chart_data],
-        y=[row[1] for row in chart_data],
-        mode="lines",
-        name=symbol,
-    )
+    # Cap the number of points sent to the browser, keeping peaks and troughs
+    ts_values, prices = downsample(ts_values, prices)
 
     # Configure chart layout
-    if (
-        period == "1day"
-        and current_time >= market_open
-        and current_time <= market_close
-    ):
-        layout = go.Layout(
-            title=f"{symbol} Stock Price",
-            xaxis={
-                "title": "Timestamp",
-                "type": "date",
-                "range": [
-                    now.strftime("%Y-%m-%d") + " 09:30:00",
-                    now.strftime("%Y-%m-%d") + " 16:00:00",
-                ],
-                "showticklabels": False,
-                "gridcolor": "rgba(0,0,0,0)",
-            },
-            yaxis={"title": "Price", "gridcolor": "rgba(0,0,0,0)"},
-            template="plotly_white",
-        )
-    else:
-        layout = go.Layout(
-            title=f"{symbol} Stock Price",
-            xaxis={
-                "title": "Timestamp",
-                "type": "category",
-                "showticklabels": False,
-                "gridcolor": "rgba(0,0,0,0)",
-            },
-            yaxis={"title": "Price", "gridcolor": "rgba(0,0,0,0)"},
-            template="plotly_white",
-        )
+    xaxis = {
+        "gridcolor": "rgba(0,0,0,0)",
+        "showticklabels": False,
+        "title": {"text": "Timestamp"},
+        "type": "category",
+    }
+    if period == "1day" and time(9, 30) <= now.time() <= time(16, 0):
+        xaxis["type"] = "date"
+        xaxis["range"] = [
+            now.strftime("%Y-%m-%d") + " 09:30:00",
+            now.strftime("%Y-%m-%d") + " 16:00:00",
+        ]
+    yaxis = {"gridcolor": "rgba(0,0,0,0)", "title": {"text": "Price"}}
 
     # Return JSON-encoded chart configuration
-    fig = go.Figure(data=[trace], layout=layout)
-    return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    return line_chart_json(
+        symbol,
+        format_chart_times(ts_values),
+        prices,
+        f"{symbol} Stock Price",
+        xaxis,
+        yaxis,
+    )
 
 
 def get_current_stock_data(symbol):
@@ -304,29 +421,28 @@ def stock_detail(symbol):
     """
     period = request.args.get("period", "1mo")  # Default to 1 month view
 
-    # Generate chart data
-    stock_chart_json = get_stock_chart_data(symbol, period)
-
     current_stock_data = get_current_stock_data(symbol)
 
-    user_shares, portfolio = None, None
-
-    if current_user.is_authenticated:
-        connection, cursor = create_connection()
-        cursor.execute(
-            """SELECT shares FROM portfolios where user_id = ? and stock_symbol = ?""",
-            (current_user.id, symbol),
-        )
-        portfolio = cursor.fetchone()
-
-        if portfolio:
-            user_shares = portfolio[0]
+    # Fetch symbols nobody has viewed before, waiting briefly for the quote;
+    # only signed-in users may spend API calls on them
+    if (
+        current_stock_data is None
+        and current_user.is_authenticated
+        and symbol_loader.load(symbol)
+    ):
+        current_stock_data = get_current_stock_data(symbol)
 
-        connection.close()
+    # Keep viewed symbols refreshed while there is interest in them
+    if current_stock_data is not None:
+        record_view(symbol)
 
     if request.method == "POST":
         transaction_type = request.form.get("transaction_type")
 
+        if current_stock_data is None:
+            flash(f"No price available for {symbol} yet, please try again.")
+            return redirect(url_for("stock_detail", symbol=symbol))
+
         try:
             shares = int(request.form.get("shares"))
             if shares < 1:
@@ -341,6 +457,43 @@ def stock_detail(symbol):
         )
         return redirect(url_for("portfolio"))
 
+    def render():
+        return render_stock_page(symbol, period, current_stock_data)
+
+    if current_stock_data is None:
+        return render()
+
+    # Revalidation of an unchanged page is answered without rendering it
+    scopes = [f"quote:{symbol}", f"bars:{symbol}"]
+    user_id = current_user.id if current_user.is_authenticated else None
+    if user_id is not None:
+        scopes.append(f"portfolio:{user_id}")
+    etag, last_modified = get_validators(
+        scopes, symbol, period, user_id, get_market_state()
+    )
+    return conditional_response(render, etag, last_modified)
+
+
+def render_stock_page(symbol, period, current_stock_data):
+    """Render the stock page with its chart and the user's position"""
+    # Generate chart data
+    stock_chart_json = get_stock_chart_data(symbol, period)
+
+    user_shares, portfolio = None, None
+
+    if current_user.is_authenticated:
+        connection, cursor = create_connection()
+        cursor.execute(
+            """SELECT shares FROM portfolios where user_id = ? and stock_symbol = ?""",
+            (current_user.id, symbol),
+        )
+        portfolio = cursor.fetchone()
+
+        if portfolio:
+            user_shares = portfolio[0]
+
+        connection.close()
+
     return render_template(
         "stock.html",
         user_shares=user_shares,
@@ -351,43 +504,76 @@ def stock_detail(symbol):
     )
 
 
-@app.route("/portfolio")
-@login_required
-def portfolio():
-    connection, cursor = create_connection()
-    cursor.execute(
-        """SELECT * FROM portfolios WHERE user_id = ? ORDER BY stock_symbol ASC""",
-        (current_user.id,),
+@app.route("/stock/<symbol>/chart")
+def stock_chart_delta(symbol):
+    """
+    Return the chart points from a given time onward, so open charts can be
+    extended instead of reloaded
+
+    Query args:
+        period: Chart period, defaults to '1mo'
+        since: Time of the last point the client has, as epoch seconds or
+            'YYYY-MM-DD HH:MM:SS'; that point is included again because the
+            latest bar or bucket may have changed since it was sent
+    """
+    period = request.args.get("period", "1mo")
+    since = request.args.get("since", "")
+
+    try:
+        since_ts = int(since) if since.isdigit() else timestamp_to_epoch(since)
+    except ValueError:
+        since_ts = None
+
+    def render():
+        ts_values, prices = get_chart_series(symbol, period, since_ts)
+        return jsonify(
+            {
+                "symbol": symbol,
+                "period": period,
+                "x": format_chart_times(ts_values),
+                "y": prices.tolist(),
+            }
+        )
+
+    # Points only change when bars are stored, so polling clients usually
+    # get a 304; the same for every user, so shared caches may keep it
+    etag, last_modified = get_validators(
+        [f"bars:{symbol}"], symbol, period, since_ts, get_market_state()
     )
-    portfolio_data = cursor.fetchall()
-    connection.close()
+    return conditional_response(render, etag, last_modified, public=True)
 
-    return render_template("portfolio.html", portfolio_data=portfolio_data)
 
+@app.route("/stock/<symbol>/stream")
+def stock_stream(symbol):
+    """
+    Stream quote and new bar updates for a symbol as Server-Sent Events
 
-def refresh_stock_data():
-    """Update stock data for tracked symbols"""
-    # List of tracked stocks (limited to 20 on lowest paid API tier))
-    tracked_symbols = ["TSLA", "AAPL", "NVDA", "MSFT", "WMT"]
-    update_current_month_data(tracked_symbols)
-    update_daily_price_history(tracked_symbols)
-    update_current_stock_data(tracked_symbols)
-    update_all_portfolios()
+    Args:
+        symbol: Stock ticker symbol
+    """
+    return Response(
+        live_updates.stream(symbol),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
-if __name__ == "__main__":
-    # Initial data update
-    refresh_stock_data()
-
-    # Configure scheduler for periodic updates
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(
-        func=refresh_stock_data,
-        trigger="interval",
-        seconds=60,  # Update every minute
-        misfire_grace_time=30,
+@app.route("/portfolio")
+@login_required
+def portfolio():
+    def render():
+        portfolio_data = get_portfolio(current_user.id)
+        return render_template("portfolio.html", portfolio_data=portfolio_data)
+
+    # Holdings change with trades, their values with the held symbols' quotes
+    etag, last_modified = get_validators(
+        [f"portfolio:{current_user.id}"],
+        current_user.id,
+        holdings_user_id=current_user.id,
     )
-    scheduler.start()
+    return conditional_response(render, etag, last_modified)
 
-    # Start Flask application
+
+if __name__ == "__main__":
+    # Start Flask application, ingest runs separately in worker.py
     app.run(debug=True)
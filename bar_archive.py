@@ -0,0 +1,218 @@
+# bar_archive.py
+# Stores price bars in fixed-width binary files, one per symbol and month,
+# read back as memory-mapped NumPy arrays
+
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+from timeseries_store import PriceSeries
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Directory holding <SYMBOL>/<YYYY-MM>.bars files
+ARCHIVE_DIRECTORY = "bar_archive"
+
+# On-disk layout of one bar, 48 bytes little-endian
+BAR_DTYPE = np.dtype(
+    [
+        ("ts", "<i8"),
+        ("open", "<f8"),
+        ("high", "<f8"),
+        ("low", "<f8"),
+        ("close", "<f8"),
+        ("volume", "<i8"),
+    ]
+)
+
+
+def month_path(stock_symbol, month):
+    """Return the archive file of a symbol's bars for a 'YYYY-MM' month"""
+    return os.path.join(ARCHIVE_DIRECTORY, stock_symbol, f"{month}.bars")
+
+
+def list_months(stock_symbol):
+    """Return the archived months of a symbol in ascending order"""
+    directory = os.path.join(ARCHIVE_DIRECTORY, stock_symbol)
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.endswith(".bars")]
+    return sorted(name[: -len(".bars")] for name in names)
+
+
+# Serializes archive writes within this process where fcntl is unavailable
+write_lock = threading.Lock()
+
+
+@contextmanager
+def locked_month(stock_symbol, month):
+    """
+    Hold the write lock of one symbol-month across processes.
+
+    The lock is taken on a separate .lock file, since rewrites replace the
+    month file itself. Without fcntl (Windows) writes are only serialized
+    within this process.
+    """
+    path = month_path(stock_symbol, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if fcntl is None:
+        with write_lock:
+            yield
+        return
+
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_month(stock_symbol, month):
+    """
+    Map one month of bars into memory without copying it.
+
+    Args:
+        stock_symbol: Stock ticker symbol
+        month: Month in format 'YYYY-MM'
+
+    Returns:
+        Read-only structured array of BAR_DTYPE sorted by ts, empty if the
+        month is not archived
+    """
+    path = month_path(stock_symbol, month)
+    # A partial bar left by an interrupted append is ignored
+    count = os.path.getsize(path) // BAR_DTYPE.itemsize if os.path.exists(path) else 0
+    if not count:
+        return np.empty(0, dtype=BAR_DTYPE)
+    return np.memmap(path, dtype=BAR_DTYPE, mode="r", shape=(count,))
+
+
+def merge_bars(existing, new_bars, replace=True):
+    """
+    Combine two bar arrays sorted by ts, resolving bars with the same ts.
+
+    Args:
+        existing: Bars already stored
+        new_bars: Bars being written
+        replace: Keep the new bar on a clash instead of the existing one
+
+    Returns:
+        New structured array sorted by ts
+    """
+    combined = np.concatenate((existing, new_bars))
+    combined = combined[np.argsort(combined["ts"], kind="stable")]
+    same = combined["ts"][1:] == combined["ts"][:-1]
+
+    # Stable sort keeps existing bars before new ones with the same ts
+    if replace:
+        return combined[np.r_[~same, True]]
+    return combined[np.r_[True, ~same]]
+
+
+def write_month(stock_symbol, month, new_bars, replace=True):
+    """
+    Append or merge one month of sorted bars into its archive file.
+
+    The month is locked while it is read and written, so the worker, the
+    web app and setup.py can write the same month without losing bars.
+    """
+    path = month_path(stock_symbol, month)
+    with locked_month(stock_symbol, month):
+        existing = read_month(stock_symbol, month)
+
+        # Newer bars are appended in place, the common case during ingest
+        if not len(existing) or new_bars["ts"][0] > existing["ts"][-1]:
+            with open(path, "ab") as archive_file:
+                archive_file.truncate(len(existing) * BAR_DTYPE.itemsize)
+                archive_file.write(new_bars.tobytes())
+            return
+
+        # Older or overlapping bars rewrite the month; open maps of the
+        # previous file stay valid because the new file replaces it rather
+        # than editing it
+        merged = merge_bars(existing, new_bars, replace)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        merged.tofile(temporary_path)
+        os.replace(temporary_path, path)
+
+
+def write_bars(stock_symbol, rows, replace=True):
+    """
+    Write price_history rows for one symbol into the archive.
+
+    Args:
+        stock_symbol: Stock ticker symbol the rows belong to
+        rows: price_history rows in PRICE_HISTORY_COLUMNS order
+        replace: Overwrite existing bars instead of keeping them
+    """
+    if not rows:
+        return
+
+    series = PriceSeries.from_rows([row[1:] for row in rows])
+    bars = np.empty(len(series), dtype=BAR_DTYPE)
+    for field, column in zip(BAR_DTYPE.names, series.columns()):
+        bars[field] = column
+    bars = merge_bars(bars[:0], bars)
+
+    months = bars["ts"].astype("datetime64[s]").astype("datetime64[M]")
+    for month in np.unique(months):
+        write_month(stock_symbol, str(month), bars[months == month], replace)
+
+
+def read_range(stock_symbol, start_ts, end_ts):
+    """
+    Read the bars with start_ts <= ts <= end_ts.
+
+    A range within one month is returned as a zero-copy view of the mapped
+    file, longer ranges are concatenated.
+
+    Returns:
+        Structured array of BAR_DTYPE sorted by ts
+    """
+    first_month, last_month = (
+        str(np.datetime64(int(ts), "s").astype("datetime64[M]"))
+        for ts in (start_ts, end_ts)
+    )
+
+    pieces = []
+    for month in list_months(stock_symbol):
+        if first_month <= month <= last_month:
+            bars = read_month(stock_symbol, month)
+            start = np.searchsorted(bars["ts"], start_ts, side="left")
+            end = np.searchsorted(bars["ts"], end_ts, side="right")
+            pieces.append(bars[start:end])
+
+    if len(pieces) == 1:
+        return pieces[0]
+    if not pieces:
+        return np.empty(0, dtype=BAR_DTYPE)
+    return np.concatenate(pieces)
+
+
+def load_series(stock_symbol):
+    """Read a symbol's whole archive as a PriceSeries"""
+    pieces = [read_month(stock_symbol, month) for month in list_months(stock_symbol)]
+    bars = np.concatenate(pieces) if pieces else np.empty(0, dtype=BAR_DTYPE)
+    columns = (np.ascontiguousarray(bars[field]) for field in BAR_DTYPE.names)
+    return PriceSeries(*columns)
+
+
+def clear_archive():
+    """Delete every archived bar file"""
+    if not os.path.isdir(ARCHIVE_DIRECTORY):
+        return
+    for stock_symbol in os.listdir(ARCHIVE_DIRECTORY):
+        for month in list_months(stock_symbol):
+            with locked_month(stock_symbol, month):
+                os.remove(month_path(stock_symbol, month))
+
+
+if __name__ == "__main__":
+    from database import export_price_history
+
+    export_price_history()
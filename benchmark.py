@@ -0,0 +1,321 @@
+# benchmark.py
+# Micro-benchmarks for the data ingestion and serving paths
+# Runs against a temporary database with synthetic data, no API calls are made
+
+import io
+import os
+import random
+import tempfile
+import tracemalloc
+from itertools import islice
+from datetime import datetime, timedelta
+from time import perf_counter
+import json
+import plotly
+import plotly.graph_objs as go
+import shutil
+import database
+import app
+import bar_archive
+from timeseries_store import timeseries_store
+from chart_json import line_chart_json
+from downsampling import downsample
+from stock_data import (
+    iter_time_series_rows,
+    process_intraday_price_history,
+    process_intraday_time_series,
+    timestamp_to_epoch,
+)
+
+
+def make_intraday_payload(bars=8000, start=datetime(2024, 1, 2, 9, 31)):
+    """
+    Build a synthetic TIME_SERIES_INTRADAY response.
+
+    Args:
+        bars: Number of one-minute bars to generate
+        start: Timestamp of the first bar
+
+    Returns:
+        Dictionary shaped like the Alpha Vantage intraday JSON response
+    """
+    time_series = {}
+    price = 100.0
+    timestamp = start
+
+    while len(time_series) < bars:
+        # Only generate bars during market hours
+        if timestamp.hour < 16 and (timestamp.hour, timestamp.minute) > (9, 30):
+            price = max(1.0, price + random.uniform(-0.5, 0.5))
+            time_series[timestamp.strftime("%Y-%m-%d %H:%M:%S")] = {
+                "1. open": f"{price:.4f}",
+                "2. high": f"{price + 0.25:.4f}",
+                "3. low": f"{price - 0.25:.4f}",
+                "4. close": f"{price:.4f}",
+                "5. volume": str(random.randint(100, 100000)),
+            }
+        timestamp += timedelta(minutes=1)
+
+    return {"Time Series (1min)": time_series}
+
+
+def use_temporary_database():
+    """Point the database module at a fresh temporary database file"""
+    handle, path = tempfile.mkstemp(suffix=".db")
+    os.close(handle)
+    database.DATABASE_PATH = path
+    database.create_tables()
+    return path
+
+
+def ingest_row_by_row(cursor, intraday_data):
+    """Before: one processed dict and one execute per bar"""
+    for timestamp in list(intraday_data["Time Series (1min)"].keys()):
+        processed_data = process_intraday_price_history(
+            intraday_data, "TEST", timestamp
+        )
+        cursor.execute(
+            """
+        INSERT OR REPLACE INTO price_history
+            (stock_symbol, ts, open_price, high_price, low_price, price, volume)
+            VALUES  (?, ?, ?, ?, ?, ?, ?)
+        """,
+            (
+                processed_data["stock_symbol"],
+                timestamp_to_epoch(processed_data["timestamp"]),
+                processed_data["open_price"],
+                processed_data["high_price"],
+                processed_data["low_price"],
+                processed_data["close_price"],
+                processed_data["volume"],
+            ),
+        )
+
+
+def ingest_executemany(cursor, intraday_data):
+    """After: one pass over the payload and a single executemany"""
+    rows = process_intraday_time_series(intraday_data, "TEST")
+    cursor.executemany(
+        """
+    INSERT OR REPLACE INTO price_history
+        (stock_symbol, ts, open_price, high_price, low_price, price, volume)
+        VALUES  (?, ?, ?, ?, ?, ?, ?)
+    """,
+        rows,
+    )
+
+
+def benchmark_intraday_ingest(bars=50000, rounds=31):
+    """Compare row-by-row and executemany ingestion, median of many rounds"""
+    intraday_data = make_intraday_payload(bars)
+    methods = (("Row by row", ingest_row_by_row), ("executemany", ingest_executemany))
+    timings = {name: [] for name, _ in methods}
+
+    # Every run gets a fresh database, and the order alternates between
+    # rounds, so neither method benefits from the other's pages or WAL
+    for round_number in range(rounds):
+        order = methods if round_number % 2 == 0 else methods[::-1]
+        for name, ingest in order:
+            path = use_temporary_database()
+            connection, cursor = database.create_connection()
+            start = perf_counter()
+            ingest(cursor, intraday_data)
+            connection.commit()
+            timings[name].append(perf_counter() - start)
+            connection.close()
+            os.remove(path)
+
+    print(f"\nIntraday ingest ({bars:,} bars, median of {rounds} rounds):")
+    for name, _ in methods:
+        elapsed = sorted(timings[name])
+        median = elapsed[len(elapsed) // 2]
+        print(
+            f"{name + ':':<13}{bars / median:,.0f} rows/second "
+            f"(range {bars / elapsed[-1]:,.0f} - {bars / elapsed[0]:,.0f})"
+        )
+
+
+def benchmark_portfolio_valuation(holdings, holdings_per_user=10, symbols=500):
+    """Compare stored (eager) and read-time (lazy) portfolio valuation"""
+    path = use_temporary_database()
+    connection, cursor = database.create_connection()
+
+    cursor.executemany(
+        """INSERT INTO stocks_current VALUES (?, 1, 1, 1, ?, 1, '', 1, 0, 0)""",
+        [(f"S{number}", 100.0) for number in range(symbols)],
+    )
+    cursor.executemany(
+        """INSERT INTO portfolios
+        (user_id, stock_symbol, shares, average_price, percent_change,
+        total_cost_basis, current_value, gain_loss_dollars)
+        VALUES (?, ?, 10, 100.0, 0, 1000.0, 1000.0, 0)""",
+        [
+            (number // holdings_per_user, f"S{number % symbols}")
+            for number in range(holdings)
+        ],
+    )
+    cursor.execute("UPDATE stocks_current SET price = price + 1")
+    connection.commit()
+    connection.close()
+
+    # Write load: eager mode rewrites every holding after each price tick
+    start = perf_counter()
+    revalued = database.update_all_portfolios()
+    eager_write = perf_counter() - start
+
+    # Page latency: average read of one user's portfolio in each mode
+    users = range(0, holdings // holdings_per_user, max(1, holdings // 10000))
+    latencies = {}
+    for lazy in (False, True):
+        database.LAZY_PORTFOLIO_VALUATION = lazy
+        start = perf_counter()
+        for user_id in users:
+            database.get_portfolio(user_id)
+        latencies[lazy] = (perf_counter() - start) / len(users)
+    os.remove(path)
+
+    print(f"\nPortfolio valuation ({holdings:,} holdings):")
+    print(f"Eager: {revalued:,} rows written per tick in {eager_write * 1000:.1f} ms")
+    print("Lazy:  0 rows written per tick")
+    print(f"Page query, stored values: {latencies[False] * 1000:.3f} ms")
+    print(f"Page query, read-time values: {latencies[True] * 1000:.3f} ms")
+
+
+def load_chart_history(symbol="TEST"):
+    """Store a year of minute bars and five years of daily bars ending today"""
+    now = datetime.now().replace(second=0, microsecond=0)
+    intraday_data = make_intraday_payload(365 * 390, now - timedelta(days=365))
+    database.save_price_bars(
+        symbol, process_intraday_time_series(intraday_data, symbol), "intraday"
+    )
+
+    daily_rows = []
+    price = 100.0
+    day = now - timedelta(days=5 * 365)
+    while day < now - timedelta(days=365):
+        if day.weekday() < 5:
+            price = max(1.0, price + random.uniform(-2, 2))
+            timestamp = day.strftime("%Y-%m-%d") + " 16:00:00"
+            daily_rows.append(
+                (symbol, timestamp_to_epoch(timestamp), price, price + 1, price - 1)
+                + (price, random.randint(10**5, 10**7))
+            )
+        day += timedelta(days=1)
+    database.save_price_bars(symbol, daily_rows, "daily", replace=False)
+
+
+def plotly_figure_json(symbol, x, y, xaxis, yaxis):
+    """Previous serializer: graph objects encoded with PlotlyJSONEncoder"""
+    trace = go.Scatter(x=x, y=y.tolist(), mode="lines", name=symbol)
+    layout = go.Layout(
+        title=f"{symbol} Stock Price",
+        xaxis=xaxis,
+        yaxis=yaxis,
+        template="plotly_white",
+    )
+    fig = go.Figure(data=[trace], layout=layout)
+    return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def benchmark_chart_serialization(repeat=20):
+    """Compare per-request CPU of the previous and current chart paths"""
+    path = use_temporary_database()
+    load_chart_history()
+    xaxis = {"title": {"text": "Timestamp"}, "type": "category"}
+    yaxis = {"title": {"text": "Price"}}
+
+    # Load the columnar series once, as the first chart request would
+    start = perf_counter()
+    database.get_price_series("TEST")
+    print(f"\nColumnar series load: {(perf_counter() - start) * 1000:.1f} ms")
+
+    print("\nChart request CPU (ms per request):")
+    print(f"{'Period':<8}{'Points':>8}{'Columnar':>10}{'Plotly':>10}{'Lean':>10}")
+    for period in ("1day", "1week", "1mo", "3mo", "6mo", "1y", "5y"):
+        start = perf_counter()
+        for _ in range(repeat):
+            ts_values, prices = downsample(*app.get_chart_series("TEST", period))
+            times = app.format_chart_times(ts_values)
+        columnar = (perf_counter() - start) / repeat
+
+        timings = []
+        for serialize in (plotly_figure_json, line_chart_json):
+            start = perf_counter()
+            for _ in range(repeat):
+                if serialize is line_chart_json:
+                    serialize("TEST", times, prices, "TEST Stock Price", xaxis, yaxis)
+                else:
+                    serialize("TEST", times, prices, xaxis, yaxis)
+            timings.append((perf_counter() - start) / repeat)
+
+        print(
+            f"{period:<8}{len(times):>8}{columnar * 1000:>10.2f}"
+            f"{timings[0] * 1000:>10.2f}{timings[1] * 1000:>10.2f}"
+        )
+    os.remove(path)
+
+
+def benchmark_cold_load():
+    """Compare loading a symbol's history from SQLite and from the bar archive"""
+    path = use_temporary_database()
+    load_chart_history()
+    bar_archive.ARCHIVE_DIRECTORY = tempfile.mkdtemp()
+    database.export_price_history()
+
+    print("\nCold load of 1 year of minute bars and 4 years of daily bars:")
+    for backend in ("sqlite", "archive"):
+        database.PRICE_HISTORY_BACKEND = backend
+        timeseries_store.clear()
+        start = perf_counter()
+        series = database.get_price_series("TEST")
+        elapsed = perf_counter() - start
+        print(f"{backend:<8} {len(series):,} bars in {elapsed * 1000:.1f} ms")
+
+    archive_bytes = sum(
+        os.path.getsize(bar_archive.month_path("TEST", month))
+        for month in bar_archive.list_months("TEST")
+    )
+    sqlite_bytes = sum(
+        os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name)
+    )
+    print(f"SQLite file: {sqlite_bytes / 2**20:.1f} MB")
+    print(f"Archive files: {archive_bytes / 2**20:.1f} MB")
+
+    database.PRICE_HISTORY_BACKEND = "sqlite"
+    shutil.rmtree(bar_archive.ARCHIVE_DIRECTORY)
+    os.remove(path)
+
+
+def benchmark_streaming_parse(bars=100000):
+    """Compare peak memory of decoding a whole response and streaming it"""
+    payload = json.dumps(make_intraday_payload(bars)).encode()
+
+    def decode_whole():
+        process_intraday_time_series(json.loads(payload), "TEST")
+
+    def stream_chunks():
+        rows = iter_time_series_rows(io.BytesIO(payload), "TEST")
+        for _ in iter(lambda: list(islice(rows, database.STREAM_CHUNK_ROWS)), []):
+            pass
+
+    print(f"\nParsing a {len(payload) / 2**20:.1f} MB intraday response:")
+    for name, parse in (("json.loads", decode_whole), ("Streaming", stream_chunks)):
+        start = perf_counter()
+        parse()
+        elapsed = perf_counter() - start
+
+        # Measured on a second run, tracing allocations slows parsing down
+        tracemalloc.start()
+        parse()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:<11} peak {peak / 2**20:.1f} MB in {elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    benchmark_intraday_ingest()
+    for holdings in (10000, 100000):
+        benchmark_portfolio_valuation(holdings)
+    benchmark_chart_serialization()
+    benchmark_cold_load()
+    benchmark_streaming_parse()
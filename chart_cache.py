@@ -0,0 +1,100 @@
+# chart_cache.py
+# In-process cache of serialized chart JSON, invalidated when new bars are stored
+
+import threading
+from collections import OrderedDict
+
+# Upper bound on the total size of cached chart JSON
+CHART_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ChartCache:
+    """
+    LRU cache of chart JSON strings keyed by (symbol, period).
+
+    Each entry also records the market state it was built for (trading date
+    and whether the market was open), since the chart window depends on it.
+    Writers call invalidate() after committing new bars for a symbol; a
+    per-symbol generation counter stops a chart built from older data from
+    being stored after such an invalidation.
+    """
+
+    def __init__(self, max_bytes=CHART_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (symbol, period) -> (market_state, json)
+        self.generations = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def generation(self, symbol):
+        """Return the symbol's generation, taken before building a chart"""
+        with self.lock:
+            return self.generations.get(symbol, 0)
+
+    def get(self, symbol, period, market_state):
+        """Return cached chart JSON, or None if missing or built for another state"""
+        key = (symbol, period)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != market_state:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, symbol, period, market_state, chart_json, generation):
+        """
+        Store chart JSON unless the symbol was invalidated while it was built.
+
+        Args:
+            symbol: Stock ticker symbol
+            period: Chart period the JSON was built for
+            market_state: Market state the JSON was built for
+            chart_json: Serialized chart
+            generation: Value of generation(symbol) taken before building
+        """
+        size = len(chart_json)
+        if size > self.max_bytes:
+            return
+
+        key = (symbol, period)
+        with self.lock:
+            if self.generations.get(symbol, 0) != generation:
+                return
+
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.size -= len(previous[1])
+
+            self.entries[key] = (market_state, chart_json)
+            self.size += size
+
+            # Evict least recently used charts until back under the memory cap
+            while self.size > self.max_bytes:
+                _, (_, evicted_json) = self.entries.popitem(last=False)
+                self.size -= len(evicted_json)
+
+    def invalidate(self, symbol):
+        """Drop every cached chart for a symbol after new bars were committed"""
+        with self.lock:
+            self.generations[symbol] = self.generations.get(symbol, 0) + 1
+            for key in [key for key in self.entries if key[0] == symbol]:
+                self.size -= len(self.entries.pop(key)[1])
+
+    def get_stats(self):
+        """Summarize cache size and hit rate"""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Shared cache used by the web app and invalidated by the database writers
+chart_cache = ChartCache()
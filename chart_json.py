@@ -0,0 +1,90 @@
+# chart_json.py
+# Builds Plotly chart JSON straight from column arrays, without graph objects
+
+import base64
+import json
+from functools import lru_cache
+import numpy as np
+import plotly.io as pio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Send y values as base64 float64 typed arrays instead of JSON number lists.
+# Needs plotly.js 2.28 or newer; the templates load plotly-latest from the CDN,
+# which is frozen at 1.x, so this stays off unless the script tag is changed.
+CHART_TYPED_ARRAYS = False
+
+
+@lru_cache(maxsize=None)
+def get_template(name="plotly_white"):
+    """Return a Plotly layout template as plain JSON data, built once per name"""
+    return pio.templates[name].to_plotly_json()
+
+
+def encode_values(values):
+    """
+    Convert a numeric column to the form stored in the figure JSON.
+
+    Args:
+        values: NumPy array or list of numbers
+
+    Returns:
+        Typed array dictionary when CHART_TYPED_ARRAYS is on, otherwise the
+        values as given (orjson) or as a list (json)
+    """
+    if CHART_TYPED_ARRAYS:
+        data = np.asarray(values, dtype="<f8").tobytes()
+        return {"dtype": "f8", "bdata": base64.b64encode(data).decode("ascii")}
+    if orjson is None and isinstance(values, np.ndarray):
+        return values.tolist()
+    return values
+
+
+def dumps(figure):
+    """Serialize figure data, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(figure, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(figure, separators=(",", ":"))
+
+
+def line_chart_json(name, x, y, title, xaxis, yaxis, template="plotly_white"):
+    """
+    Build the JSON of a single-trace line chart.
+
+    Produces the same figure as go.Figure(go.Scatter(...), go.Layout(...))
+    encoded with PlotlyJSONEncoder, but skips building and validating the
+    graph objects.
+
+    Args:
+        name: Trace name
+        x: List of x values (timestamp strings)
+        y: NumPy array or list of y values
+        title: Chart title
+        xaxis: Layout dictionary for the x axis
+        yaxis: Layout dictionary for the y axis
+        template: Name of the Plotly template to apply
+
+    Returns:
+        JSON string with 'data' and 'layout' keys
+    """
+    figure = {
+        "data": [
+            {
+                "mode": "lines",
+                "name": name,
+                "x": x,
+                "y": encode_values(y),
+                "type": "scatter",
+            }
+        ],
+        "layout": {
+            "template": get_template(template),
+            "title": {"text": title},
+            "xaxis": xaxis,
+            "yaxis": yaxis,
+        },
+    }
+    return dumps(figure)
@@ -1,44 +1,246 @@
 # database.py
 # Handles all database operations including setup, updates, and queries
 
+import queue
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from itertools import islice
 from stock_data import (
-    process_current_stock_data,
-    get_stock_data,
-    process_intraday_price_history,
+    get_current_quotes,
+    get_stock_data_batch,
+    process_intraday_time_series,
+    stream_time_series,
+    MAX_FETCH_WORKERS,
 )
+from rate_limiter import PRIORITY_INTRADAY
+from stock_data import (
+    epoch_to_timestamp,
+    datetime_to_epoch,
+    MARKET_OPEN_MINUTE,
+    MARKET_CLOSE_MINUTE,
+)
+from chart_cache import chart_cache
+from timeseries_store import timeseries_store, PriceSeries
+import bar_archive
+from live_updates import live_updates
 from apscheduler.schedulers.background import BackgroundScheduler
 from time import sleep, time
 import pandas_market_calendars as mcal
 
+# Path to the SQLite database file
+DATABASE_PATH = "portfolio.db"
+
+# Pragmas applied to every new connection; the busy timeout waits out short
+# write locks. WAL journaling, which lets readers work while the scheduler
+# writes, is stored in the database file and set once by create_tables.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # 16 MB page cache
+    "PRAGMA mmap_size = 268435456",  # 256 MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Idle reader connections kept in the pool shared by all threads
+MAX_IDLE_CONNECTIONS = 8
+
+# Seconds a thread waits for the writer connection before giving up
+WRITER_WAIT_SECONDS = 60
+
+# Idle reader connections, most recently used first, and the single shared
+# writer connection
+idle_connections = queue.LifoQueue(maxsize=MAX_IDLE_CONNECTIONS)
+writer_lock = threading.Lock()
+writer_connection = None
+
+# Price history table - one row per bar, price holds the closing price
+# Columns: stock_symbol, ts (epoch seconds of the exchange-local time),
+#          open_price, high_price, low_price, price, volume (OHLV columns
+#          are NULL for bars stored close-only)
+PRICE_HISTORY_TABLE = """
+    CREATE TABLE IF NOT EXISTS price_history(
+        stock_symbol TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        open_price REAL,
+        high_price REAL,
+        low_price REAL,
+        price REAL NOT NULL,
+        volume INTEGER,
+        PRIMARY KEY(stock_symbol, ts)
+    ) WITHOUT ROWID
+"""
+
+# Derive current value, % change and gain/loss from stocks_current when
+# portfolios are read instead of rewriting them for every holding each minute
+LAZY_PORTFOLIO_VALUATION = True
+
+# Symbols always kept up to date, whether or not anyone holds or views them
+DEFAULT_TRACKED_SYMBOLS = ["TSLA", "AAPL", "NVDA", "MSFT", "WMT"]
+
+# Rows written per transaction when storing a streamed API response
+STREAM_CHUNK_ROWS = 5000
+
+# data_versions written by this process, as scope -> (first, last) version of
+# its latest unbroken run of writes, so the version watcher skips them
+local_versions = {}
+local_versions_lock = threading.Lock()
+
+# Number of most recent bars returned by the compact intraday output
+COMPACT_INTRADAY_BARS = 100
+
+# Where price bars are stored: "sqlite" for the price_history table, or
+# "archive" for the memory-mapped files of bar_archive.py. Quotes, portfolios,
+# users, transactions and sync watermarks always stay in SQLite.
+PRICE_HISTORY_BACKEND = "sqlite"
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    SQLite connection that goes back to the pool when close() is called.
+
+    Like a real close, anything left uncommitted is rolled back first.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        release_connection(self)
+
+    def close_for_real(self):
+        super().close()
+
+
+def open_connection():
+    """Open a new pooled connection with tuned pragmas"""
+    connection = sqlite3.connect(
+        DATABASE_PATH, factory=PooledConnection, check_same_thread=False
+    )
+    connection.database_path = DATABASE_PATH
+    connection.is_writer = False
+    for pragma in CONNECTION_PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+
+def create_connection(writer=False):
+    """
+    Get a pooled connection to the SQLite database
+
+    Reader connections come from a pool shared by all threads, so request
+    threads reuse connections opened by earlier ones. With writer=True the
+    single process-wide writer connection is returned instead, and the
+    writer lock is held until it is closed, so background writes never
+    contend for the database with each other. Callers close it in a finally
+    block; a checkout that is never closed makes other writers time out
+    after WRITER_WAIT_SECONDS instead of waiting forever.
+
+    Args:
+        writer: Whether to check out the writer connection
+
+    Returns:
+        Tuple of (connection, cursor)
+
+    Raises:
+        sqlite3.OperationalError: If the writer connection stays busy
+    """
+    global writer_connection
+
+    if writer and not writer_lock.acquire(timeout=WRITER_WAIT_SECONDS):
+        raise sqlite3.OperationalError("Timed out waiting for the writer connection")
 
-def create_connection():
-    """Create a connection to the SQLite database"""
     try:
-        connection = sqlite3.connect("portfolio.db")
+        if writer:
+            if (
+                writer_connection is None
+                or writer_connection.database_path != DATABASE_PATH
+            ):
+                writer_connection = open_connection()
+                writer_connection.is_writer = True
+            connection = writer_connection
+        else:
+            # Connections to a previous DATABASE_PATH are not reused
+            connection = None
+            while connection is None:
+                try:
+                    connection = idle_connections.get_nowait()
+                except queue.Empty:
+                    connection = open_connection()
+                    break
+                if connection.database_path != DATABASE_PATH:
+                    connection.close_for_real()
+                    connection = None
+
         cursor = connection.cursor()
         return connection, cursor
     except sqlite3.Error as e:
+        if writer:
+            writer_lock.release()
         print(f"Database connection error: {e}")
         return None, None
 
 
+def release_connection(connection):
+    """Return a connection checked out by create_connection to the pool"""
+    if connection.is_writer:
+        writer_lock.release()
+        return
+
+    try:
+        idle_connections.put_nowait(connection)
+    except queue.Full:
+        connection.close_for_real()
+
+
 def create_tables():
     """Create all necessary database tables if they don't exist"""
-    connection, cursor = create_connection()
+    connection, cursor = create_connection(writer=True)
+    try:
+        # Stored in the database file, so every later connection uses WAL
+        cursor.execute("PRAGMA journal_mode = WAL")
+        create_schema(cursor)
+        connection.commit()
+    finally:
+        connection.close()
+
 
-    # Price history table - stores every price update
-    # Columns: id, stock_symbol, price, timestamp
+def create_schema(cursor):
+    """Create the tables, indexes and views, migrating older layouts first"""
+    # Move price history stored by older versions over to the current schema
+    migrate_price_history(cursor)
+    migrate_price_rollups(cursor)
+
+    # Price history table - stores every OHLCV bar, clustered by symbol and
+    # time so chart queries are range seeks on the primary key
+    cursor.execute(PRICE_HISTORY_TABLE)
+
+    # Sync state table - newest bar stored per symbol and dataset, used as the
+    # watermark for incremental syncs
+    # Columns: stock_symbol, dataset ('intraday' or 'daily'), last_ts, synced_at
     cursor.execute(
         """
-    CREATE TABLE IF NOT EXISTS price_history(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE IF NOT EXISTS sync_state(
         stock_symbol TEXT NOT NULL,
-        price REAL NOT NULL,
-        timestamp TEXT NOT NULL,
-        UNIQUE(stock_symbol, timestamp)
+        dataset TEXT NOT NULL,
+        last_ts INTEGER NOT NULL,
+        synced_at TEXT NOT NULL,
+        PRIMARY KEY(stock_symbol, dataset)
+    ) WITHOUT ROWID
+    """
     )
+
+    # Backfill checkpoints - one row per symbol-month fully stored by setup.py
+    # Columns: stock_symbol, month ('YYYY-MM'), bars, completed_at
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS backfill_progress(
+        stock_symbol TEXT NOT NULL,
+        month TEXT NOT NULL,
+        bars INTEGER NOT NULL,
+        completed_at TEXT NOT NULL,
+        PRIMARY KEY(stock_symbol, month)
+    ) WITHOUT ROWID
     """
     )
 
@@ -79,6 +281,30 @@ def create_tables():
     """
     )
 
+    # Portfolio valuations view - portfolios columns with the valuation fields
+    # computed from the latest quote (stored values are used when there is none)
+    cursor.execute(
+        """
+    CREATE VIEW IF NOT EXISTS portfolio_valuations AS
+    SELECT portfolios.id, portfolios.user_id, portfolios.stock_symbol,
+        portfolios.shares, portfolios.average_price,
+        COALESCE(
+            ((quote.price / portfolios.average_price) - 1) * 100,
+            portfolios.percent_change
+        ) AS percent_change,
+        portfolios.total_cost_basis,
+        COALESCE(
+            portfolios.shares * quote.price, portfolios.current_value
+        ) AS current_value,
+        COALESCE(
+            portfolios.shares * quote.price - portfolios.total_cost_basis,
+            portfolios.gain_loss_dollars
+        ) AS gain_loss_dollars
+    FROM portfolios
+    LEFT JOIN stocks_current AS quote ON quote.stock_symbol = portfolios.stock_symbol
+    """
+    )
+
     cursor.execute(
         """
     CREATE TABLE IF NOT EXISTS transactions(
@@ -106,16 +332,149 @@ def create_tables():
     """
     )
 
-    connection.commit()
-    connection.close()
+    # Tracked symbol registry - symbols refreshed by the scheduler besides the
+    # ones held in portfolios, see symbol_registry.py
+    # Columns: stock_symbol, pinned (always tracked), last_viewed (epoch
+    # seconds), view_count
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS tracked_symbols(
+        stock_symbol TEXT PRIMARY KEY,
+        pinned INTEGER NOT NULL DEFAULT 0,
+        last_viewed INTEGER,
+        view_count INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """
+    )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO tracked_symbols (stock_symbol, pinned) VALUES (?, 1)",
+        [(symbol,) for symbol in DEFAULT_TRACKED_SYMBOLS],
+    )
+
+    # First loads - API fetches started for symbols nobody had viewed yet,
+    # counted against their share of the API budget, see symbol_registry.py
+    # Columns: stock_symbol, loaded_at (epoch seconds)
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS first_loads(
+        stock_symbol TEXT NOT NULL,
+        loaded_at INTEGER NOT NULL
+    )
+    """
+    )
+
+    # Data versions - bumped by every writer in the same transaction as the
+    # data, and used to build HTTP validators for pages showing that data and
+    # by web processes to follow writes made by the ingest worker
+    # Scopes: 'quote:<symbol>', 'bars:<symbol>', 'portfolio:<user_id>'
+    # Columns: scope, version, updated_at (epoch seconds), changed_from
+    #          (earliest bar ts of the last bars write)
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS data_versions(
+        scope TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        changed_from INTEGER
+    ) WITHOUT ROWID
+    """
+    )
+    cursor.execute("PRAGMA table_info(data_versions)")
+    if "changed_from" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE data_versions ADD COLUMN changed_from INTEGER")
+
+    # Worker leases - the process holding an unexpired lease is the only one
+    # running the ingest jobs, see worker.py
+    # Columns: name, owner (host:pid), expires_at (epoch seconds)
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS worker_leases(
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """
+    )
+
+
+def migrate_price_history(cursor):
+    """
+    Bring a price_history table created by an older version up to date.
+
+    TEXT timestamps are converted to the typed schema, close-only tables
+    gain the open/high/low/volume columns, and the trading_date and
+    minute_of_day columns, which nothing reads since charts moved to the
+    in-memory series, are dropped.
+
+    Args:
+        cursor: Cursor of the connection performing the migration
+    """
+    cursor.execute("PRAGMA table_info(price_history)")
+    columns = [row[1] for row in cursor.fetchall()]
+
+    if "timestamp" in columns:
+        print("Migrating price_history to epoch timestamps...")
+        cursor.execute("ALTER TABLE price_history RENAME TO price_history_old")
+        cursor.execute(PRICE_HISTORY_TABLE)
+        cursor.execute(
+            """
+        INSERT OR IGNORE INTO price_history (stock_symbol, ts, price)
+            SELECT stock_symbol, CAST(strftime('%s', timestamp) AS INTEGER), price
+            FROM price_history_old
+        """
+        )
+        cursor.execute("DROP TABLE price_history_old")
+        return
+
+    if columns and "volume" not in columns:
+        print("Adding OHLCV columns to price_history...")
+        for column in ("open_price REAL", "high_price REAL", "low_price REAL"):
+            cursor.execute(f"ALTER TABLE price_history ADD COLUMN {column}")
+        cursor.execute("ALTER TABLE price_history ADD COLUMN volume INTEGER")
+
+    if "trading_date" in columns:
+        print("Dropping trading_date and minute_of_day from price_history...")
+        cursor.execute("ALTER TABLE price_history RENAME TO price_history_old")
+        cursor.execute(PRICE_HISTORY_TABLE)
+        cursor.execute(
+            """
+        INSERT INTO price_history
+            (stock_symbol, ts, open_price, high_price, low_price, price, volume)
+            SELECT stock_symbol, ts, open_price, high_price, low_price, price, volume
+            FROM price_history_old
+        """
+        )
+        cursor.execute("DROP TABLE price_history_old")
+
+
+def migrate_price_rollups(cursor):
+    """
+    Drop the price_rollups table kept by older versions, once.
+
+    Charts resample the in-memory series of each symbol instead, so the
+    rollup buckets rebuilt on every write are no longer read.
+
+    Args:
+        cursor: Cursor of the connection performing the migration
+    """
+    cursor.execute(
+        """SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name = 'price_rollups'"""
+    )
+    if cursor.fetchone():
+        print("Dropping the unused price_rollups table...")
+        cursor.execute("DROP TABLE price_rollups")
 
 
 def clear_price_history():
     """Clear all data from the price_history table"""
-    connection, cursor = create_connection()
+    connection, cursor = create_connection(writer=True)
     try:
         cursor.execute("DELETE FROM price_history")
         connection.commit()
+        if PRICE_HISTORY_BACKEND == "archive":
+            bar_archive.clear_archive()
+        timeseries_store.clear()
         print("Successfully cleared price_history table")
     except Exception as e:
         print(f"Error clearing data: {e}")
@@ -127,169 +486,747 @@ def update_current_stock_data(stock_symbols):
     """
     Update current stock information for specified symbols
 
+    Only quotes whose market data differs from the stored row are written
+    and have their version bumped, so unchanged quotes keep pages cached.
+
     Args:
         stock_symbols: List of stock ticker symbols to update
-    """
-    try:
-        connection, cursor = create_connection()
-
-        for symbol in stock_symbols:
-            quote_data, symbol = get_stock_data(
-                symbol, daily_data_needed=False, intraday_data_needed=False
-            )
-
-            if not quote_data:
-                continue
 
-            processed_data = process_current_stock_data(quote_data, symbol)
+    Returns:
+        Number of quotes fetched, whether or not they changed
+    """
+    quotes = get_current_quotes(stock_symbols)
+    if not quotes:
+        return 0
+
+    rows = [
+        (
+            quote["stock_symbol"],
+            quote["open_price"],
+            quote["high_price"],
+            quote["low_price"],
+            quote["price"],
+            quote["volume"],
+            quote["latest_timestamp"],
+            quote["previous_close"],
+            quote["change"],
+            quote["change_percent"],
+        )
+        for quote in quotes
+    ]
 
-            if not processed_data:
-                continue
+    # Hold the writer connection only while writing, not while fetching
+    connection, cursor = create_connection(writer=True)
+    try:
+        # The timestamp label follows the clock, so it is left out of the check
+        cursor.execute(
+            f"""
+            SELECT stock_symbol, open_price, high_price, low_price, price,
+            volume, previous_close, change, change_percent
+            FROM stocks_current
+            WHERE stock_symbol IN ({", ".join("?" * len(rows))})
+        """,
+            [row[0] for row in rows],
+        )
+        stored = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+        changed = [row for row in rows if stored.get(row[0]) != row[1:6] + row[7:]]
 
-            # Update stocks_current table with latest data
-            cursor.execute(
+        if changed:
+            cursor.executemany(
                 """
                 INSERT OR REPLACE INTO stocks_current 
                 (stock_symbol, open_price, high_price, low_price, price,
                 volume, latest_trading_day, previous_close, change, change_percent)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-                (
-                    processed_data["stock_symbol"],
-                    processed_data["open_price"],
-                    processed_data["high_price"],
-                    processed_data["low_price"],
-                    processed_data["price"],
-                    processed_data["volume"],
-                    processed_data["latest_timestamp"],
-                    processed_data["previous_close"],
-                    processed_data["change"],
-                    processed_data["change_percent"],
-                ),
+                changed,
             )
-            connection.commit()
-
+            versions = bump_data_versions(
+                cursor, [f"quote:{row[0]}" for row in changed]
+            )
+        connection.commit()
     except Exception as e:
+        connection.rollback()
         print(f"Error updating stock data: {e}")
+        return 0
+    finally:
+        connection.close()
+
+    changed_symbols = {row[0] for row in changed}
+    for quote in quotes:
+        if quote["stock_symbol"] in changed_symbols:
+            live_updates.publish(quote["stock_symbol"], "quote", quote)
+    if changed:
+        record_local_versions(versions)
+    return len(quotes)
+
+
+def store_price_bars(cursor, stock_symbol, rows, dataset, replace=True):
+    """
+    Write price_history rows for one symbol and keep derived data in step.
+
+    Advances the symbol's sync watermark, and bumps its bars version if
+    any bar was added or differs from the stored one. The caller commits.
+    With the archive backend the bars go to bar_archive files, only the
+    watermark is written to SQLite and every write counts as a change.
+
+    Args:
+        cursor: Cursor of the connection doing the write
+        stock_symbol: Stock ticker symbol the rows belong to
+        rows: price_history rows in PRICE_HISTORY_COLUMNS order
+        dataset: Sync watermark to advance ('intraday' or 'daily')
+        replace: Overwrite existing bars instead of keeping them
+
+    Returns:
+        Dictionary of the bumped data_versions scope to its new version,
+        empty if no stored bar changed
+    """
+    if not rows:
+        return {}
+
+    bar_times = [row[1] for row in rows]
+    if PRICE_HISTORY_BACKEND == "archive":
+        bar_archive.write_bars(stock_symbol, rows, replace)
+        changed = True
+    else:
+        # Identical bars are neither rewritten nor counted as changes
+        conflict = "NOTHING"
+        if replace:
+            conflict = """UPDATE SET open_price = excluded.open_price,
+            high_price = excluded.high_price, low_price = excluded.low_price,
+            price = excluded.price, volume = excluded.volume
+            WHERE (open_price, high_price, low_price, price, volume)
+            IS NOT (excluded.open_price, excluded.high_price,
+            excluded.low_price, excluded.price, excluded.volume)"""
+        changes_before = cursor.connection.total_changes
+        cursor.executemany(
+            f"""
+        INSERT INTO price_history
+            (stock_symbol, ts, open_price, high_price, low_price, price, volume)
+            VALUES  (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(stock_symbol, ts) DO {conflict}
+        """,
+            rows,
+        )
+        changed = cursor.connection.total_changes > changes_before
+
+    cursor.execute(
+        """
+    INSERT INTO sync_state (stock_symbol, dataset, last_ts, synced_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(stock_symbol, dataset) DO UPDATE
+        SET last_ts = MAX(last_ts, excluded.last_ts), synced_at = excluded.synced_at
+    """,
+        (stock_symbol, dataset, max(bar_times), datetime.now().isoformat()),
+    )
+    if not changed:
+        return {}
+    return bump_data_versions(cursor, [f"bars:{stock_symbol}"], min(bar_times))
+
+
+def save_price_bars(stock_symbol, rows, dataset, replace=True):
+    """
+    Store bars for one symbol in their own transaction on the writer connection
+
+    Args:
+        stock_symbol: Stock ticker symbol the rows belong to
+        rows: price_history rows in PRICE_HISTORY_COLUMNS order
+        dataset: Sync watermark to advance ('intraday' or 'daily')
+        replace: Overwrite existing bars instead of keeping them
+    """
+    connection, cursor = create_connection(writer=True)
+    try:
+        versions = store_price_bars(cursor, stock_symbol, rows, dataset, replace)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    if versions:
+        notify_bars_stored(stock_symbol, rows, replace)
+        record_local_versions(versions)
+
+
+def save_price_bar_stream(
+    stock_symbol, rows, dataset, replace=True, chunk_size=STREAM_CHUNK_ROWS
+):
+    """
+    Store bars from an iterator in fixed-size transactions as they arrive
+
+    Only one chunk is held in memory at a time, and the writer connection is
+    released between chunks so other writers are not held up by the download.
+
+    Args:
+        stock_symbol: Stock ticker symbol the rows belong to
+        rows: Iterable of price_history rows, newest first as the API sends them
+        dataset: Sync watermark to advance ('intraday' or 'daily')
+        replace: Overwrite existing bars instead of keeping them
+        chunk_size: Number of rows written per transaction
+
+    Returns:
+        Number of rows stored
+    """
+    rows = iter(rows)
+    stored = 0
+    written_versions = []
+    newest_chunk = []
+
+    for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+        connection, cursor = create_connection(writer=True)
+        try:
+            versions = store_price_bars(cursor, stock_symbol, chunk, dataset, replace)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        stored += len(chunk)
+        newest_chunk = newest_chunk or chunk
+        if versions:
+            written_versions.append(versions)
+
+    if written_versions:
+        # Reload the in-memory series on next use rather than merging every
+        # chunk into it, then notify as for a single write of the newest bars
+        timeseries_store.invalidate(stock_symbol)
+        notify_bars_stored(stock_symbol, newest_chunk, replace)
+        for versions in written_versions:
+            record_local_versions(versions)
+    return stored
+
+
+def stream_price_history(
+    stock_symbol,
+    month=None,
+    dataset="intraday",
+    priority=None,
+    outputsize="full",
+    since_ts=None,
+    replace=True,
+):
+    """
+    Download one symbol's price history and store it while it streams in
+
+    Args:
+        stock_symbol: Stock ticker symbol
+        month: Optional month for intraday data (format: 'YYYY-MM')
+        dataset: 'intraday' for 1-minute bars or 'daily' for daily bars
+        priority: Optional rate limiter lane
+        outputsize: 'full' for the whole series or 'compact' for the latest 100 bars
+        since_ts: Optional epoch seconds, only newer bars are stored
+        replace: Overwrite existing bars instead of keeping them
+
+    Returns:
+        Number of rows stored
+    """
+    rows = stream_time_series(
+        stock_symbol, month, dataset == "daily", priority, outputsize
+    )
+    if since_ts is not None:
+        rows = (row for row in rows if row[1] > since_ts)
+    return save_price_bar_stream(stock_symbol, rows, dataset, replace)
+
+
+def stream_price_history_batch(
+    stock_symbols, month=None, watermarks=None, max_workers=MAX_FETCH_WORKERS, **kwargs
+):
+    """
+    Stream price history for many symbols concurrently.
+
+    Args:
+        stock_symbols: List of stock ticker symbols
+        month: Optional month for intraday data (format: 'YYYY-MM')
+        watermarks: Optional dictionary of symbol to epoch seconds, only newer
+            bars are stored for these symbols
+        max_workers: Maximum number of requests in flight at once
+        **kwargs: dataset, priority, outputsize and replace for stream_price_history
+
+    Yields:
+        Tuples of (stock_symbol, rows stored) in completion order, rows stored
+        is None if the request failed
+    """
+    watermarks = watermarks or {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                stream_price_history,
+                symbol,
+                month,
+                since_ts=watermarks.get(symbol),
+                **kwargs,
+            ): symbol
+            for symbol in stock_symbols
+        }
+        for future in as_completed(futures):
+            symbol = futures[future]
+            try:
+                yield symbol, future.result()
+            except Exception as e:
+                print(f"Error streaming price history for {symbol}: {e}")
+                yield symbol, None
+
+
+def notify_bars_stored(stock_symbol, rows, replace=True):
+    """
+    Let in-process caches know that bars for a symbol were committed.
+
+    Args:
+        stock_symbol: Stock ticker symbol the rows belong to
+        rows: price_history rows that were written
+        replace: Whether the rows overwrote existing bars
+    """
+    if not rows:
+        return
+
+    timeseries_store.append(stock_symbol, rows, replace)
+    chart_cache.invalidate(stock_symbol)
+
+    # Push the new bars, oldest first, to clients streaming this symbol
+    if live_updates.has_subscribers(stock_symbol):
+        bars = [
+            {
+                "time": epoch_to_timestamp(row[1]),
+                "open": row[2],
+                "high": row[3],
+                "low": row[4],
+                "close": row[5],
+                "volume": row[6],
+            }
+            for row in sorted(rows, key=lambda row: row[1])
+        ]
+        live_updates.publish(stock_symbol, "bars", bars)
+
+
+def get_price_series(stock_symbol):
+    """
+    Get a symbol's full price history as NumPy columns.
+
+    The first call per symbol reads price_history (or the bar archive) once,
+    later calls are served from the in-memory store that the ingest path
+    keeps current.
+
+    Args:
+        stock_symbol: Stock ticker symbol
+
+    Returns:
+        PriceSeries sorted by timestamp, empty if the symbol has no bars
+    """
+    series = timeseries_store.get(stock_symbol)
+    if series is not None:
+        return series
+
+    generation = timeseries_store.generation(stock_symbol)
+    if PRICE_HISTORY_BACKEND == "archive":
+        series = bar_archive.load_series(stock_symbol)
+    else:
+        connection, cursor = create_connection()
+        cursor.execute(
+            """
+        SELECT ts, open_price, high_price, low_price, price, volume
+        FROM price_history
+        WHERE stock_symbol = ?
+        ORDER BY ts ASC
+        """,
+            (stock_symbol,),
+        )
+        series = PriceSeries.from_rows(cursor.fetchall())
+        connection.close()
+
+    timeseries_store.put(stock_symbol, series, generation)
+    return series
+
+
+def export_price_history():
+    """
+    Copy every bar in price_history into the bar archive.
+
+    Run once before switching PRICE_HISTORY_BACKEND to "archive". Existing
+    archive bars with the same timestamp are overwritten, so it is safe to
+    run again.
+    """
+    connection, cursor = create_connection()
+    cursor.execute("SELECT DISTINCT stock_symbol FROM price_history")
+    stock_symbols = [row[0] for row in cursor.fetchall()]
+
+    for symbol in stock_symbols:
+        cursor.execute(
+            """
+        SELECT stock_symbol, ts, open_price, high_price, low_price, price, volume
+        FROM price_history
+        WHERE stock_symbol = ?
+        ORDER BY ts ASC
+        """,
+            (symbol,),
+        )
+        rows = cursor.fetchall()
+        bar_archive.write_bars(symbol, rows)
+        print(f"Archived {len(rows)} bars for {symbol}")
+    connection.close()
+
+
+def bump_data_versions(cursor, scopes, changed_from=None):
+    """
+    Mark data as changed, in the caller's write transaction.
+
+    Args:
+        cursor: Cursor of the connection doing the write
+        scopes: data_versions scopes whose data was written
+        changed_from: Optional earliest bar ts written, for bars scopes
+
+    Returns:
+        Dictionary of scope to its new version
+    """
+    now = int(time())
+    cursor.executemany(
+        """
+    INSERT INTO data_versions (scope, version, updated_at, changed_from)
+        VALUES (?, 1, ?, ?)
+        ON CONFLICT(scope) DO UPDATE
+        SET version = version + 1, updated_at = excluded.updated_at,
+        changed_from = excluded.changed_from
+    """,
+        [(scope, now, changed_from) for scope in scopes],
+    )
+    cursor.execute(
+        f"""SELECT scope, version FROM data_versions
+        WHERE scope IN ({", ".join("?" * len(scopes))})""",
+        list(scopes),
+    )
+    return dict(cursor.fetchall())
+
+
+def record_local_versions(versions):
+    """
+    Remember data versions this process wrote, once it has updated its own
+    caches and live streams for them, so the version watcher skips them.
+
+    Args:
+        versions: Dictionary of data_versions scope to the version written
+    """
+    with local_versions_lock:
+        for scope, version in versions.items():
+            first, last = local_versions.get(scope, (version, version))
+            if last != version - 1:
+                first = version
+            local_versions[scope] = (first, version)
+
+
+def get_data_versions(scopes, holdings_user_id=None):
+    """
+    Read the current versions of some data, for building HTTP validators.
+
+    Args:
+        scopes: data_versions scopes to read
+        holdings_user_id: Optional user ID whose held symbols' quote versions
+            are read as well
+
+    Returns:
+        Tuple of (sorted list of (scope, version) pairs for the scopes that
+        were ever written, latest updated_at or None)
+    """
+    query = f"""SELECT scope, version, updated_at FROM data_versions
+        WHERE scope IN ({",".join("?" * len(scopes))})"""
+    parameters = list(scopes)
+    if holdings_user_id is not None:
+        query += """ OR scope IN (SELECT 'quote:' || stock_symbol FROM portfolios
+            WHERE user_id = ?)"""
+        parameters.append(holdings_user_id)
+
+    connection, cursor = create_connection()
+    cursor.execute(query, parameters)
+    rows = cursor.fetchall()
+    connection.close()
+
+    versions = sorted((scope, version) for scope, version, _ in rows)
+    updated_at = max((row[2] for row in rows), default=None)
+    return versions, updated_at
+
+
+def get_sync_watermarks(cursor, stock_symbols, dataset):
+    """
+    Look up the newest stored bar for each symbol.
+
+    Returns:
+        Dictionary of symbol to epoch seconds, symbols never synced are omitted
+    """
+    placeholders = ", ".join("?" * len(stock_symbols))
+    cursor.execute(
+        f"""SELECT stock_symbol, last_ts FROM sync_state
+        WHERE dataset = ? AND stock_symbol IN ({placeholders})""",
+        (dataset, *stock_symbols),
+    )
+    return dict(cursor.fetchall())
+
+
+def count_session_minutes(start_ts, end_ts):
+    """
+    Count the regular-session weekday minutes between two bar times.
+
+    Holidays are counted as trading days, so the result can only overstate
+    the number of bars missing between the two times.
+
+    Args:
+        start_ts: Epoch seconds of the earlier exchange-local time
+        end_ts: Epoch seconds of the later exchange-local time
+
+    Returns:
+        Number of session minutes in between
+    """
+    minutes = 0
+    for day in range(int(start_ts) // 86400, int(end_ts) // 86400 + 1):
+        # Day 0 was a Thursday, so weekdays are 0-4 counting from Monday
+        if (day + 3) % 7 >= 5:
+            continue
+        session_open = day * 86400 + MARKET_OPEN_MINUTE * 60
+        session_close = day * 86400 + MARKET_CLOSE_MINUTE * 60
+        overlap = min(end_ts, session_close) - max(start_ts, session_open)
+        minutes += max(0, int(overlap)) // 60
+    return minutes
+
+
+def get_stored_bar(stock_symbol, ts):
+    """
+    Read one stored bar of a symbol.
+
+    Returns:
+        Tuple of (open, high, low, close, volume), or None if not stored
+    """
+    if PRICE_HISTORY_BACKEND == "archive":
+        bars = bar_archive.read_range(stock_symbol, ts, ts)
+        if not len(bars):
+            return None
+        bar = bars[0]
+        return (
+            float(bar["open"]),
+            float(bar["high"]),
+            float(bar["low"]),
+            float(bar["close"]),
+            int(bar["volume"]),
+        )
+
+    connection, cursor = create_connection()
+    cursor.execute(
+        """
+    SELECT open_price, high_price, low_price, price, volume
+    FROM price_history WHERE stock_symbol = ? AND ts = ?
+    """,
+        (stock_symbol, ts),
+    )
+    bar = cursor.fetchone()
+    connection.close()
+    return bar
+
+
+def get_completed_backfill(stock_symbols, months):
+    """
+    Look up which symbol-months the backfill has already stored.
+
+    Args:
+        stock_symbols: List of stock symbols being backfilled
+        months: List of months being backfilled, format 'YYYY-MM'
+
+    Returns:
+        Set of (stock_symbol, month) tuples
+    """
+    connection, cursor = create_connection()
+    cursor.execute("SELECT stock_symbol, month FROM backfill_progress")
+    completed = {
+        (symbol, month)
+        for symbol, month in cursor.fetchall()
+        if symbol in stock_symbols and month in months
+    }
+    connection.close()
+    return completed
+
+
+def mark_backfill_complete(stock_symbol, month, bars):
+    """Checkpoint a symbol-month whose intraday bars have been stored"""
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(
+            """
+        INSERT OR REPLACE INTO backfill_progress
+            (stock_symbol, month, bars, completed_at)
+            VALUES (?, ?, ?, ?)
+        """,
+            (stock_symbol, month, bars, datetime.now().isoformat()),
+        )
+        connection.commit()
     finally:
         connection.close()
 
 
-def update_intraday_price_history(stock_symbols, month):
+def update_intraday_price_history(stock_symbols, month, priority=PRIORITY_INTRADAY):
     """
     Update intraday price history for specified symbols and month
 
     Args:
         stock_symbols: List of stock ticker symbols to update
         month: Month to update in format 'YYYY-MM'
+        priority: Rate limiter lane for the API calls
     """
-    try:
-        connection, cursor = create_connection()
+    for symbol, stored in stream_price_history_batch(
+        stock_symbols, month, dataset="intraday", priority=priority
+    ):
+        if not stored:
+            print(f"Skipping {symbol} - no data available")
 
-        for symbol in stock_symbols:
-            intraday_data, symbol = get_stock_data(
-                symbol, month, daily_data_needed=False, current_data_needed=False
-            )
+
+def sync_intraday_price_history(stock_symbols):
+    """
+    Bring intraday price history up to date, fetching and writing only new bars.
+
+    Symbols missing fewer session minutes than the compact output holds
+    (latest 100 bars) fetch only that, and store the bars after the
+    watermark plus the last stored bar if it changed while it was still
+    forming. Nothing is written when no bar changed, so caches and charts
+    stay valid. Symbols that were never synced fetch the full current
+    month instead. Symbols whose gap is wider than the compact output fetch
+    every month from their watermark's month through the current one, so a
+    gap reaching back across a month boundary is filled too.
+
+    Args:
+        stock_symbols: List of stock ticker symbols to sync
+    """
+    connection, cursor = create_connection()
+    watermarks = get_sync_watermarks(cursor, stock_symbols, "intraday")
+    connection.close()
+
+    now = datetime_to_epoch(datetime.now())
+    compact_symbols = [
+        symbol
+        for symbol, watermark in watermarks.items()
+        if count_session_minutes(watermark, now) < COMPACT_INTRADAY_BARS
+    ]
+    full_sync_symbols = [s for s in stock_symbols if s not in compact_symbols]
+
+    try:
+        for intraday_data, symbol in get_stock_data_batch(
+            compact_symbols,
+            daily_data_needed=False,
+            current_data_needed=False,
+            outputsize="compact",
+        ):
 
             if not intraday_data:
                 print(f"Skipping {symbol} - no data available")
                 continue
 
-            timestamps = list(intraday_data["Time Series (1min)"].keys())
+            rows = process_intraday_time_series(intraday_data, symbol)
+            if not rows:
+                continue
 
-            for timestamp in timestamps:
-                processed_data = process_intraday_price_history(
-                    intraday_data, symbol, timestamp
-                )
+            watermark = watermarks[symbol]
+            if min(row[1] for row in rows) > watermark:
+                # Bars are missing between the watermark and the compact window
+                full_sync_symbols.append(symbol)
+                continue
 
-                cursor.execute(
-                    """
-                INSERT OR REPLACE INTO price_history
-                    (stock_symbol, price, timestamp)
-                    VALUES  (?, ?, ?)
-                """,
-                    (
-                        processed_data["stock_symbol"],
-                        processed_data["close_price"],
-                        processed_data["timestamp"],
-                    ),
-                )
+            new_rows = [row for row in rows if row[1] > watermark]
+            last_rows = [row for row in rows if row[1] == watermark]
+            if last_rows and tuple(last_rows[0][2:]) != get_stored_bar(
+                symbol, watermark
+            ):
+                new_rows += last_rows
 
-        connection.commit()
+            if new_rows:
+                save_price_bars(symbol, new_rows, "intraday")
     except Exception as e:
-        print(f"Error updating intraday data: {e}")
-    finally:
-        connection.close()
+        print(f"Error syncing intraday data: {e}")
 
+    if not full_sync_symbols:
+        return
 
-def update_all_portfolios():
-    try:
-        connection, cursor = create_connection()
+    current_month = get_current_trading_month()
+    symbols_by_month = {}
+    for symbol in full_sync_symbols:
+        first_month = current_month
+        if symbol in watermarks:
+            first_month = min(epoch_to_timestamp(watermarks[symbol])[:7], first_month)
+        for month in get_months_between(first_month, current_month):
+            symbols_by_month.setdefault(month, []).append(symbol)
 
-        # Get all unique user IDs that have transactions
-        cursor.execute("""SELECT DISTINCT user_id FROM transactions""")
-        user_ids = [row[0] for row in cursor.fetchall()]
+    for month in sorted(symbols_by_month):
+        update_intraday_price_history(symbols_by_month[month], month)
 
-        if not user_ids:
-            print("No users with transactions found. Skipping portfolio update.")
-            return
 
-        for user_id in user_ids:
-            cursor.execute(
-                """SELECT DISTINCT stock_symbol FROM transactions WHERE user_id = ?""",
-                (user_id,),
-            )
-            stock_symbols = [row[0] for row in cursor.fetchall()]
+def update_all_portfolios():
+    """
+    Revalue every holding from the latest quotes in one set-based UPDATE
 
-            for stock_symbol in stock_symbols:
+    Only holdings whose stored value no longer matches shares times the
+    current price are written, and holdings without a quote are left as is.
 
-                cursor.execute(
-                    """SELECT price
-                                FROM stocks_current
-                                WHERE stock_symbol = ?""",
-                    (stock_symbol,),
-                )
-                current_price_result = cursor.fetchone()
-                current_price = current_price_result[0]
+    Returns:
+        Number of holdings revalued
+    """
+    # UPDATE ... FROM needs SQLite 3.33, older versions use correlated lookups
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        query = """
+            UPDATE portfolios
+            SET percent_change = ((quote.price / portfolios.average_price) - 1) * 100,
+                current_value = portfolios.shares * quote.price,
+                gain_loss_dollars = portfolios.shares * quote.price
+                    - portfolios.total_cost_basis
+            FROM stocks_current AS quote
+            WHERE quote.stock_symbol = portfolios.stock_symbol
+            AND portfolios.current_value != portfolios.shares * quote.price
+        """
+    else:
+        price = """(SELECT price FROM stocks_current
+            WHERE stocks_current.stock_symbol = portfolios.stock_symbol)"""
+        query = f"""
+            UPDATE portfolios
+            SET percent_change = (({price} / average_price) - 1) * 100,
+                current_value = shares * {price},
+                gain_loss_dollars = shares * {price} - total_cost_basis
+            WHERE current_value != shares * {price}
+        """
 
-                cursor.execute(
-                    """SELECT average_price, shares, total_cost_basis
-                                FROM portfolios
-                                where user_id = ? and stock_symbol = ?""",
-                    (user_id, stock_symbol),
-                )
-                portfolio_data = cursor.fetchone()
-
-                if portfolio_data:
-                    average_price = portfolio_data[0]
-                    shares = portfolio_data[1]
-                    total_cost_basis = portfolio_data[2]
-
-                    percent_change = ((current_price / average_price) - 1) * 100
-
-                    current_value = shares * current_price
-
-                    gain_loss_dollars = current_value - total_cost_basis
-
-                    cursor.execute(
-                        """UPDATE portfolios
-                                    SET percent_change = ?, current_value = ?, gain_loss_dollars = ?
-                                    WHERE user_id = ? AND stock_symbol = ?""",
-                        (
-                            percent_change,
-                            current_value,
-                            gain_loss_dollars,
-                            user_id,
-                            stock_symbol,
-                        ),
-                    )
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(query)
+        revalued = cursor.rowcount
+        if revalued:
+            cursor.execute("""SELECT DISTINCT user_id FROM portfolios""")
+            bump_data_versions(
+                cursor, [f"portfolio:{row[0]}" for row in cursor.fetchall()]
+            )
         connection.commit()
+        return revalued
     except Exception as e:
         print(f"Porfolio not showing. Error: {e}")
+        return 0
     finally:
         connection.close()
 
 
+def get_portfolio(user_id):
+    """
+    Get a user's holdings, valued at read time when LAZY_PORTFOLIO_VALUATION is set
+
+    Args:
+        user_id: User ID
+
+    Returns:
+        List of rows with the portfolios table columns, ordered by symbol
+    """
+    source = "portfolio_valuations" if LAZY_PORTFOLIO_VALUATION else "portfolios"
+
+    connection, cursor = create_connection()
+    cursor.execute(
+        f"""SELECT * FROM {source} WHERE user_id = ? ORDER BY stock_symbol ASC""",
+        (user_id,),
+    )
+    portfolio_data = cursor.fetchall()
+    connection.close()
+    return portfolio_data
+
+
 def process_transaction(
     user_id, stock_symbol, transaction_type, shares, price_per_share
 ):
@@ -303,7 +1240,7 @@ def process_transaction(
         shares: Number of shares
         price_per_share: Price per share
     """
-    connection, cursor = create_connection()
+    connection, cursor = create_connection(writer=True)
 
     try:
         cursor.execute(
@@ -418,6 +1355,7 @@ def process_transaction(
                                 WHERE user_id = ? AND stock_symbol = ?""",
                     (user_id, stock_symbol),
                 )
+        bump_data_versions(cursor, [f"portfolio:{user_id}"])
         connection.commit()
     except Exception as e:
         connection.rollback()
@@ -426,14 +1364,37 @@ def process_transaction(
         connection.close()
 
 
-def update_current_month_data(stock_symbols):
-    """Update price history for current month for specified symbols"""
+def get_current_trading_month():
+    """Return the month of the latest NYSE trading day in format 'YYYY-MM'"""
     nyse = mcal.get_calendar("NYSE")
     end_date = datetime.now()
     start_date = end_date - timedelta(days=10)
     valid_days = nyse.valid_days(start_date=start_date, end_date=end_date)
-    current_month = valid_days[-1].strftime("%Y-%m")
-    update_intraday_price_history(stock_symbols, current_month)
+    return valid_days[-1].strftime("%Y-%m")
+
+
+def get_months_between(first_month, last_month):
+    """
+    List the months from first_month through last_month.
+
+    Args:
+        first_month: First month in format 'YYYY-MM'
+        last_month: Last month in format 'YYYY-MM'
+
+    Returns:
+        List of months in format 'YYYY-MM', oldest first
+    """
+    year, month = int(first_month[:4]), int(first_month[5:7])
+    months = []
+    while f"{year:04d}-{month:02d}" <= last_month:
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def update_current_month_data(stock_symbols):
+    """Update price history for current month for specified symbols"""
+    update_intraday_price_history(stock_symbols, get_current_trading_month())
 
 
 if __name__ == "__main__":
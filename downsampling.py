@@ -0,0 +1,112 @@
+# downsampling.py
+# Reduces long price series to a fixed number of points before they are charted
+
+import numpy as np
+
+# Most points sent to the browser for a single chart trace
+CHART_POINT_BUDGET = 1500
+
+# 'lttb' keeps the visual shape best, 'minmax' is cheaper and keeps every extreme
+CHART_DOWNSAMPLING = "lttb"
+
+
+def lttb(x, y, budget):
+    """
+    Pick points with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are always kept. The points in between are
+    split into equal buckets, and each bucket keeps the point that forms
+    the largest triangle with the point kept from the previous bucket and
+    the average of the next bucket, so peaks and troughs survive.
+
+    Args:
+        x: NumPy array of x values in ascending order
+        y: NumPy array of y values
+        budget: Number of points to keep
+
+    Returns:
+        NumPy array of the indices of the kept points
+    """
+    count = len(x)
+    if budget >= count or budget < 3:
+        return np.arange(count)
+
+    # Bucket boundaries over the interior points, every bucket is non-empty
+    edges = np.linspace(1, count - 1, budget - 1).astype(np.int64)
+    sizes = np.diff(edges)
+
+    # Average point of every bucket, the last bucket looks ahead to the end
+    next_x = np.append(np.add.reduceat(x[: count - 1], edges[:-1]) / sizes, x[-1])
+    next_y = np.append(np.add.reduceat(y[: count - 1], edges[:-1]) / sizes, y[-1])
+
+    selected = np.empty(budget, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    anchor = 0
+
+    for bucket in range(budget - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        anchor_x, anchor_y = x[anchor], y[anchor]
+        next_avg_x, next_avg_y = next_x[bucket + 1], next_y[bucket + 1]
+
+        # Twice the triangle area, the constant factor does not change the max
+        areas = np.abs(
+            (anchor_x - next_avg_x) * (y[start:end] - anchor_y)
+            - (anchor_x - x[start:end]) * (next_avg_y - anchor_y)
+        )
+        anchor = start + int(areas.argmax())
+        selected[bucket + 1] = anchor
+
+    return selected
+
+
+def min_max_decimate(y, budget):
+    """
+    Keep the lowest and highest point of each bucket.
+
+    Args:
+        y: NumPy array of y values
+        budget: Number of points to keep at most
+
+    Returns:
+        NumPy array of the indices of the kept points, in ascending order
+    """
+    count = len(y)
+    # Two points per bucket, leaving room for the first and last point
+    buckets = (budget - 2) // 2
+    if budget >= count or buckets < 1:
+        return np.arange(count)
+
+    # Pad to a whole number of buckets by repeating the last value
+    bucket_size = -(-count // buckets)
+    padded = np.pad(y, (0, buckets * bucket_size - count), mode="edge")
+    grid = padded.reshape(buckets, bucket_size)
+
+    offsets = np.arange(buckets) * bucket_size
+    lows = np.minimum(offsets + grid.argmin(axis=1), count - 1)
+    highs = np.minimum(offsets + grid.argmax(axis=1), count - 1)
+    return np.unique(np.concatenate(([0], lows, highs, [count - 1])))
+
+
+def downsample(x, y, budget=CHART_POINT_BUDGET, method=CHART_DOWNSAMPLING):
+    """
+    Cap a series at a point budget while preserving its shape.
+
+    Args:
+        x: Sequence of numeric x values (e.g. epoch seconds) in ascending order
+        y: Sequence of y values
+        budget: Number of points to keep at most
+        method: 'lttb' or 'minmax'
+
+    Returns:
+        Tuple of (x, y) NumPy arrays holding the kept points
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    if method == "minmax":
+        indices = min_max_decimate(y, budget)
+    else:
+        indices = lttb(x, y, budget)
+
+    return x[indices], y[indices]
@@ -0,0 +1,95 @@
+# live_updates.py
+# Pushes quote and price bar updates to browsers over Server-Sent Events
+
+import json
+import queue
+import threading
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_SECONDS = 15
+
+# Updates buffered per client before the oldest ones are dropped
+MAX_PENDING_UPDATES = 100
+
+
+class LiveUpdateBroadcaster:
+    """
+    Fan-out of per-symbol update events to connected stream clients.
+
+    Every client gets its own bounded queue, so a slow client only loses
+    its own oldest updates and never blocks the publisher.
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # symbol -> set of client queues
+        self.lock = threading.Lock()
+
+    def subscribe(self, symbol):
+        client_queue = queue.Queue(maxsize=MAX_PENDING_UPDATES)
+        with self.lock:
+            self.subscribers.setdefault(symbol, set()).add(client_queue)
+        return client_queue
+
+    def unsubscribe(self, symbol, client_queue):
+        with self.lock:
+            clients = self.subscribers.get(symbol, set())
+            clients.discard(client_queue)
+            if not clients:
+                self.subscribers.pop(symbol, None)
+
+    def has_subscribers(self, symbol):
+        with self.lock:
+            return bool(self.subscribers.get(symbol))
+
+    def publish(self, symbol, event, data):
+        """
+        Send an event to every client streaming a symbol.
+
+        Args:
+            symbol: Stock ticker symbol the update is for
+            event: Event name ('quote' or 'bars')
+            data: JSON-serializable payload
+        """
+        with self.lock:
+            clients = list(self.subscribers.get(symbol, ()))
+
+        if not clients:
+            return
+
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        for client_queue in clients:
+            while True:
+                try:
+                    client_queue.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        client_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def stream(self, symbol):
+        """
+        Generate the Server-Sent Events stream for one client.
+
+        Args:
+            symbol: Stock ticker symbol to stream updates for
+
+        Yields:
+            SSE-formatted messages, with heartbeats while idle
+        """
+        client_queue = self.subscribe(symbol)
+        try:
+            # Tell the browser how long to wait before reconnecting
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    yield client_queue.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+        finally:
+            self.unsubscribe(symbol, client_queue)
+
+
+# Shared broadcaster fed by the database writers and read by the stream route
+live_updates = LiveUpdateBroadcaster()
@@ -0,0 +1,210 @@
+# rate_limiter.py
+# Shared rate limiting and request scheduling for Alpha Vantage API calls
+
+import heapq
+import itertools
+import sqlite3
+import threading
+from collections import deque
+from datetime import date, datetime
+from time import monotonic, time
+
+# Priority lanes, lower values are served first
+PRIORITY_CURRENT = 0  # Current quotes shown to users
+PRIORITY_INTRADAY = 1  # Recent intraday bars for the current month
+PRIORITY_BACKFILL = 2  # Historical backfill and daily history
+
+LANE_NAMES = {
+    PRIORITY_CURRENT: "current",
+    PRIORITY_INTRADAY: "intraday",
+    PRIORITY_BACKFILL: "backfill",
+}
+
+
+class RateLimiter:
+    """
+    Token bucket that every API call has to draw from.
+
+    Each spent token is returned to the bucket exactly one window after it
+    was used, so no rolling window ever sees more than `calls_per_window`
+    calls while bursts up to the full allowance are still allowed. Callers
+    queue for a token instead of failing; waiting callers are served by
+    priority lane first and arrival order second.
+
+    With a state_path, every call is also recorded in that SQLite file and
+    a token is only granted while the calls recorded there fit the window
+    and the daily cap, so all processes sharing the file share one plan
+    allowance. Priority lanes then order callers within each process.
+    """
+
+    def __init__(
+        self, calls_per_window, window_seconds=60, calls_per_day=None, state_path=None
+    ):
+        self.calls_per_window = calls_per_window
+        self.window_seconds = window_seconds
+        self.calls_per_day = calls_per_day
+        self.state_path = state_path
+
+        self.condition = threading.Condition()
+        self.spent = deque()  # monotonic times of calls in the current window
+        self.waiting = []  # heap of (priority, sequence) tickets
+        self.sequence = itertools.count()
+
+        self.day = date.today()
+        self.calls_today = 0
+        self.rejected = 0
+        self.lane_stats = {
+            priority: {"calls": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for priority in LANE_NAMES
+        }
+
+    def _refill(self, now):
+        """Return tokens whose window has passed and reset the daily count"""
+        while self.spent and now - self.spent[0] >= self.window_seconds:
+            self.spent.popleft()
+
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.calls_today = 0
+
+    def _daily_cap_reached(self):
+        return self.calls_per_day is not None and self.calls_today >= self.calls_per_day
+
+    def _claim_shared(self):
+        """
+        Record one call in the shared state if the recorded calls allow it.
+
+        Returns:
+            0 once the call is recorded, seconds until the oldest call in the
+            window expires if the window is full, None if the daily cap is
+            used up
+        """
+        now = time()
+        day_start = datetime.combine(date.today(), datetime.min.time()).timestamp()
+
+        # Autocommit mode so BEGIN IMMEDIATE takes the write lock right away
+        connection = sqlite3.connect(self.state_path, timeout=30, isolation_level=None)
+        try:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS api_calls (called_at REAL NOT NULL)"""
+            )
+            connection.execute("BEGIN IMMEDIATE")
+
+            # Calls older than both the window and today no longer count
+            window_start = now - self.window_seconds
+            connection.execute(
+                """DELETE FROM api_calls WHERE called_at < ?""",
+                (min(day_start, window_start),),
+            )
+            calls_today, window_calls, oldest = connection.execute(
+                """
+            SELECT TOTAL(called_at >= ?), TOTAL(called_at > ?),
+                MIN(CASE WHEN called_at > ? THEN called_at END)
+            FROM api_calls
+            """,
+                (day_start, window_start, window_start),
+            ).fetchone()
+
+            if self.calls_per_day is not None and calls_today >= self.calls_per_day:
+                wait = None
+            elif window_calls >= self.calls_per_window:
+                wait = oldest + self.window_seconds - now
+            else:
+                connection.execute(
+                    """INSERT INTO api_calls (called_at) VALUES (?)""", (now,)
+                )
+                wait = 0
+            connection.execute("COMMIT")
+            return wait
+        finally:
+            connection.close()
+
+    def acquire(self, priority=PRIORITY_CURRENT):
+        """
+        Wait for permission to make one API call.
+
+        Args:
+            priority: Priority lane of the call (PRIORITY_* constant)
+
+        Returns:
+            True once the call may be made, False if the daily cap is used up
+        """
+        queued_at = monotonic()
+
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+
+            try:
+                while True:
+                    now = monotonic()
+                    self._refill(now)
+
+                    if self._daily_cap_reached():
+                        self.rejected += 1
+                        return False
+
+                    if self.waiting[0] != ticket:
+                        self.condition.wait()
+                        continue
+
+                    if len(self.spent) < self.calls_per_window:
+                        shared_wait = 0
+                        if self.state_path:
+                            shared_wait = self._claim_shared()
+                        if shared_wait is None:
+                            self.rejected += 1
+                            return False
+                        if shared_wait > 0:
+                            # Other processes used the window, retry when it frees up
+                            self.condition.wait(shared_wait)
+                            continue
+
+                        heapq.heappop(self.waiting)
+                        self.spent.append(now)
+                        self.calls_today += 1
+                        self._record_wait(priority, now - queued_at)
+                        return True
+
+                    # Sleep until the oldest token comes back
+                    self.condition.wait(self.window_seconds - (now - self.spent[0]))
+            finally:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def _record_wait(self, priority, wait):
+        stats = self.lane_stats.setdefault(
+            priority, {"calls": 0, "total_wait": 0.0, "max_wait": 0.0}
+        )
+        stats["calls"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def get_stats(self):
+        """
+        Summarize limiter usage and queue wait times.
+
+        Returns:
+            Dictionary with daily usage, queue depth and per-lane wait metrics
+        """
+        with self.condition:
+            self._refill(monotonic())
+            lanes = {}
+            for priority, stats in self.lane_stats.items():
+                calls = stats["calls"]
+                lanes[LANE_NAMES.get(priority, str(priority))] = {
+                    "calls": calls,
+                    "average_wait": stats["total_wait"] / calls if calls else 0.0,
+                    "max_wait": stats["max_wait"],
+                }
+
+            return {
+                "calls_today": self.calls_today,
+                "calls_in_window": len(self.spent),
+                "queued": len(self.waiting),
+                "rejected": self.rejected,
+                "lanes": lanes,
+            }
@@ -3,68 +3,115 @@
 
 import sqlite3
 from apscheduler.schedulers.background import BackgroundScheduler
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import sleep, time
 from stock_data import (
-    get_stock_data,
-    process_daily_price_history,
-    process_intraday_price_history,
+    MAX_FETCH_WORKERS,
+    epoch_to_timestamp,
+    api_rate_limiter,
 )
+from rate_limiter import PRIORITY_BACKFILL
 from database import (
     create_connection,
-    update_intraday_price_history,
     clear_price_history,
     create_tables,
     update_current_month_data,
+    stream_price_history,
+    stream_price_history_batch,
+    get_sync_watermarks,
+    get_price_series,
+    get_completed_backfill,
+    mark_backfill_complete,
+    get_current_trading_month,
 )
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import pandas_market_calendars as mcal
 import pandas as pd
 
+# Number of trading days returned by the compact daily output
+COMPACT_DAILY_BARS = 100
 
-def update_daily_price_history(stock_symbols):
+
+def update_daily_price_history(stock_symbols, outputsize="full", watermarks=None):
     """
     Update daily price history for all specified stock symbols
 
     Args:
         stock_symbols: List of stock symbols to update
+        outputsize: 'full' for the whole history or 'compact' for the latest 100 days
+        watermarks: Optional dictionary of symbol to newest stored daily bar,
+            only newer bars are written for these symbols
     """
-    try:
-        connection, cursor = create_connection()
+    # Stream each symbol's daily bars into the database as they download,
+    # the existing bar for a trading day is kept
+    for symbol, stored in stream_price_history_batch(
+        stock_symbols,
+        watermarks=watermarks,
+        dataset="daily",
+        outputsize=outputsize,
+        replace=False,
+    ):
+        if not stored:
+            print(f"Skipping {symbol} - no data available")
+
+
+def get_latest_completed_session():
+    """
+    Find the most recent NYSE session that has already closed
 
-        for symbol in stock_symbols:
-            # Get daily data from API
-            daily_data, symbol = get_stock_data(
-                symbol, intraday_data_needed=False, current_data_needed=False
-            )
+    Returns:
+        Session date string in format 'YYYY-MM-DD'
+    """
+    nyse = mcal.get_calendar("NYSE")
+    now = pd.Timestamp.now(tz="UTC")
+    schedule = nyse.schedule(start_date=now - pd.Timedelta(days=10), end_date=now)
+    completed = schedule[schedule["market_close"] <= now]
+    return completed.index[-1].strftime("%Y-%m-%d")
 
-            if not daily_data:
-                print(f"Skipping {symbol} - no data available")
-                continue
 
-            # Process each trading day
-            trading_days = list(daily_data["Time Series (Daily)"].keys())
-            for date in trading_days:
-                processed_data = process_daily_price_history(daily_data, symbol, date)
-
-                # Store closing prices in price_history table
-                cursor.execute(
-                    """
-                INSERT OR IGNORE INTO price_history
-                    (stock_symbol, price, timestamp)
-                    VALUES  (?, ?, ?)
-                """,
-                    (
-                        processed_data["stock_symbol"],
-                        processed_data["close_price"],
-                        processed_data["timestamp"],
-                    ),
-                )
-
-        connection.commit()
-    except Exception as e:
-        print(f"Error setting up stock data for {symbol}: {e}")
-    finally:
-        connection.close()
+def sync_daily_price_history(stock_symbols):
+    """
+    Bring daily price history up to the latest completed NYSE session
+
+    Symbols whose newest daily bar is already from that session are skipped
+    without an API call, so this is cheap to run repeatedly after the close.
+    Symbols missing fewer sessions than the compact output holds fetch only
+    the latest 100 days, the rest fetch the full history.
+
+    Args:
+        stock_symbols: List of stock symbols to sync
+    """
+    latest_session = get_latest_completed_session()
+
+    connection, cursor = create_connection()
+    watermarks = get_sync_watermarks(cursor, stock_symbols, "daily")
+    connection.close()
+
+    nyse = mcal.get_calendar("NYSE")
+    compact_symbols, full_symbols = [], []
+
+    for symbol in stock_symbols:
+        if symbol not in watermarks:
+            full_symbols.append(symbol)
+            continue
+
+        last_date = datetime.fromtimestamp(watermarks[symbol], timezone.utc)
+        last_date = last_date.strftime("%Y-%m-%d")
+        if last_date >= latest_session:
+            continue
+
+        missing_sessions = (
+            len(nyse.valid_days(start_date=last_date, end_date=latest_session)) - 1
+        )
+        if missing_sessions < COMPACT_DAILY_BARS:
+            compact_symbols.append(symbol)
+        else:
+            full_symbols.append(symbol)
+
+    if compact_symbols:
+        update_daily_price_history(compact_symbols, "compact", watermarks)
+    if full_symbols:
+        update_daily_price_history(full_symbols, "full", watermarks)
 
 
 def get_last_12_months():
@@ -89,28 +136,110 @@ def get_last_12_months():
     return unique_months
 
 
+def backfill_intraday_history(stock_symbols, months, max_workers=MAX_FETCH_WORKERS):
+    """
+    Fetch intraday history for every symbol and month, resuming where a
+    previous run stopped
+
+    Each (symbol, month) is one job. Jobs run on a worker pool in the
+    backfill lane of the rate limiter, and each one is checkpointed in
+    backfill_progress once its bars are stored, including months the API
+    has no bars for (e.g. before the symbol was listed). Jobs whose request
+    fails, is throttled or hits the daily API cap are not checkpointed and
+    run again on the next call. The current month is never checkpointed
+    because it is still filling in.
+
+    Args:
+        stock_symbols: List of stock symbols to backfill
+        months: List of months in format 'YYYY-MM'
+        max_workers: Maximum number of requests in flight at once
+    """
+    current_month = get_current_trading_month()
+    completed = get_completed_backfill(stock_symbols, months)
+    jobs = [
+        (symbol, month)
+        for month in sorted(months, reverse=True)
+        for symbol in stock_symbols
+        if (symbol, month) not in completed
+    ]
+    print(
+        f"Backfill: {len(jobs)} symbol-months to fetch, "
+        f"{len(completed)} already done"
+    )
+
+    started = time()
+    finished = 0
+    stored_bars = 0
+    failed = 0
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            executor.submit(
+                stream_price_history,
+                symbol,
+                month,
+                dataset="intraday",
+                priority=PRIORITY_BACKFILL,
+            ): (symbol, month)
+            for symbol, month in jobs
+        }
+
+        for future in as_completed(futures):
+            symbol, month = futures[future]
+            finished += 1
+            try:
+                stored = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Error backfilling {symbol} {month}: {e}")
+                continue
+
+            # Bars were written as they streamed in, so the month is complete
+            if month != current_month:
+                mark_backfill_complete(symbol, month, stored)
+            stored_bars += stored
+
+            # Report progress with an ETA based on the rate so far
+            elapsed = time() - started
+            eta = timedelta(seconds=round(elapsed / finished * (len(jobs) - finished)))
+            print(
+                f"[{finished}/{len(jobs)}] {symbol} {month}: {stored} bars | "
+                f"{finished / elapsed * 60:.1f} jobs/min, "
+                f"{stored_bars / elapsed:,.0f} bars/s | ETA {eta}"
+            )
+    except KeyboardInterrupt:
+        print("\nBackfill interrupted, run setup.py again to resume")
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    print(f"Backfill finished: {stored_bars} bars stored in {time() - started:.0f}s")
+    if failed:
+        print(f"{failed} symbol-months failed, run setup.py again to retry them")
+
+
 if __name__ == "__main__":
+    from symbol_registry import get_tracked_symbols
+
     create_tables()
-    # List of stocks to track
-    stock_symbols = ["TSLA", "AAPL", "NVDA", "MSFT", "WMT"]
+    # Stocks to track: the defaults plus any held or recently viewed
+    stock_symbols = get_tracked_symbols()
 
     # Update daily historical data
-    update_daily_price_history(stock_symbols)
+    sync_daily_price_history(stock_symbols)
 
-    # Update intraday data for last 12 months
-    months = get_last_12_months()
-    for month in months:
-        update_intraday_price_history(stock_symbols, month)
+    # Update intraday data for last 12 months, skipping months already stored
+    backfill_intraday_history(stock_symbols, get_last_12_months())
 
-    # Print data coverage summary
-    connection, cursor = create_connection()
+    # Print data coverage summary from whichever backend holds the bars
     for symbol in stock_symbols:
-        cursor.execute(
-            "SELECT MIN(timestamp), MAX(timestamp), COUNT(*) FROM price_history WHERE stock_symbol = ?",
-            (symbol,),
-        )
-        start_date, end_date, count = cursor.fetchone()
+        series = get_price_series(symbol)
         print(f"\n{symbol}:")
-        print(f"From {start_date} to {end_date}")
-        print(f"Total records: {count}")
-    connection.close()
+        if len(series):
+            start_date = epoch_to_timestamp(series.ts[0])
+            end_date = epoch_to_timestamp(series.ts[-1])
+            print(f"From {start_date} to {end_date}")
+        print(f"Total records: {len(series)}")
+
+    # Print API usage and rate limiter queue wait times
+    print(f"\nAPI usage: {api_rate_limiter.get_stats()}")
@@ -4,9 +4,175 @@
 
 import requests
 import json
-from datetime import datetime, time, timedelta
+import calendar
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from itertools import chain
+from requests.adapters import HTTPAdapter
 from apscheduler.schedulers.background import BackgroundScheduler
 from config import API_KEY, BASE_URL
+from rate_limiter import (
+    RateLimiter,
+    PRIORITY_CURRENT,
+    PRIORITY_INTRADAY,
+    PRIORITY_BACKFILL,
+)
+import config
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# API plan limits, overridable from config.py (defaults match the free tier)
+CALLS_PER_MINUTE = getattr(config, "CALLS_PER_MINUTE", 5)
+CALLS_PER_DAY = getattr(config, "CALLS_PER_DAY", 25)
+
+# Maximum number of API requests in flight at once for batch fetches
+MAX_FETCH_WORKERS = 5
+
+# Quote many symbols per call with REALTIME_BULK_QUOTES (premium plans only),
+# falling back to one GLOBAL_QUOTE call per symbol when it is not available
+USE_BULK_QUOTES = getattr(config, "USE_BULK_QUOTES", True)
+
+# Most symbols REALTIME_BULK_QUOTES accepts in one call
+BULK_QUOTE_BATCH_SIZE = 100
+
+# Text of the API message sent when the plan does not include an endpoint
+PREMIUM_ENDPOINT_MESSAGE = "premium endpoint"
+
+# Seconds to wait for the API before giving up on a request
+REQUEST_TIMEOUT = 30
+
+# Shared keep-alive session so repeated calls reuse pooled connections
+http_session = requests.Session()
+http_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=MAX_FETCH_WORKERS),
+)
+
+# SQLite file recording recent API calls, so the worker, web app and setup.py
+# share one per-minute and per-day allowance
+API_CALLS_PATH = getattr(config, "API_CALLS_PATH", "api_calls.db")
+
+# Every API call draws from this limiter so bursts queue instead of being throttled
+api_rate_limiter = RateLimiter(
+    CALLS_PER_MINUTE, calls_per_day=CALLS_PER_DAY, state_path=API_CALLS_PATH
+)
+
+# Regular session bounds as minutes after midnight (9:30 AM - 4:00 PM EST)
+MARKET_OPEN_MINUTE = 9 * 60 + 30
+MARKET_CLOSE_MINUTE = 16 * 60
+
+# Day number of 1970-01-01, used to turn dates into epoch seconds
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# Column order of the rows built by the process_*_time_series functions
+PRICE_HISTORY_COLUMNS = (
+    "stock_symbol",
+    "ts",
+    "open_price",
+    "high_price",
+    "low_price",
+    "price",
+    "volume",
+)
+
+# Response keys Alpha Vantage uses for throttling and error messages
+API_MESSAGE_KEYS = ("Note", "Information", "Error Message")
+
+
+class ApiError(Exception):
+    """Raised when a streamed request is refused or answered with a message"""
+
+
+def datetime_to_epoch(value):
+    """
+    Convert a naive exchange-local datetime into price_history epoch seconds.
+
+    Timestamps are stored as if the exchange-local wall clock were UTC, so
+    datetime(ts, 'unixepoch') in SQLite gives back the original time.
+    """
+    return calendar.timegm(value.timetuple())
+
+
+def epoch_to_timestamp(ts):
+    """Convert price_history epoch seconds back to 'YYYY-MM-DD HH:MM:SS'"""
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def timestamp_to_epoch(timestamp):
+    """
+    Convert an API timestamp into price_history epoch seconds.
+
+    Args:
+        timestamp: Timestamp string in format 'YYYY-MM-DD HH:MM:SS'
+
+    Returns:
+        Epoch seconds of the exchange-local time
+    """
+    return (
+        date_to_epoch(timestamp[:10])
+        + int(timestamp[11:13]) * 3600
+        + int(timestamp[14:16]) * 60
+        + int(timestamp[17:19])
+    )
+
+
+@lru_cache(maxsize=4096)
+def date_to_epoch(trading_date):
+    """Epoch seconds of midnight on a 'YYYY-MM-DD' date, cached per date"""
+    return (date.fromisoformat(trading_date).toordinal() - EPOCH_ORDINAL) * 86400
+
+
+def fetch_api_json(url, stock_symbol, priority, raise_errors=False):
+    """
+    Make one rate-limited API request and decode the JSON response.
+
+    Args:
+        url: Fully built Alpha Vantage request URL
+        stock_symbol: Stock ticker symbol the request is for
+        priority: Priority lane used when queueing for the rate limiter
+        raise_errors: Raise ApiError instead of printing and returning None,
+            for callers that handle refusals and messages differently
+
+    Returns:
+        Decoded JSON data, or None if the call was refused or rejected
+    """
+    if not api_rate_limiter.acquire(priority):
+        error = f"Daily API call limit reached, skipping request for {stock_symbol}"
+        if raise_errors:
+            raise ApiError(error)
+        print(error)
+        return None
+
+    response = http_session.get(url, timeout=REQUEST_TIMEOUT)
+    data = response.json()
+
+    # Throttled and invalid requests come back as a lone message key
+    message_keys = [key for key in API_MESSAGE_KEYS if key in data]
+    if message_keys and len(data) == len(message_keys):
+        error = f"API returned no data for {stock_symbol}: {data[message_keys[0]]}"
+        if raise_errors:
+            raise ApiError(error)
+        print(error)
+        return None
+
+    return data
+
+
+def get_intraday_url(stock_symbol, month=None, outputsize="full"):
+    """Build the 1-minute TIME_SERIES_INTRADAY URL, optionally for one month"""
+    # Construct intraday API URL based on whether month is specified
+    if month:
+        return f"{BASE_URL}function=TIME_SERIES_INTRADAY&symbol={stock_symbol}&interval=1min&month={month}&outputsize={outputsize}&entitlement=delayed&extended_hours=false&apikey={API_KEY}"
+    return f"{BASE_URL}function=TIME_SERIES_INTRADAY&symbol={stock_symbol}&interval=1min&outputsize={outputsize}&entitlement=delayed&extended_hours=false&apikey={API_KEY}"
+
+
+def get_daily_url(stock_symbol, outputsize="full"):
+    """Build the TIME_SERIES_DAILY_ADJUSTED URL"""
+    return f"{BASE_URL}function=TIME_SERIES_DAILY_ADJUSTED&symbol={stock_symbol}&outputsize={outputsize}&apikey={API_KEY}"
 
 
 # CHANGE: Remove current_data_needed parameter and its related logic
@@ -16,6 +182,8 @@ def get_stock_data(
     daily_data_needed=True,
     intraday_data_needed=True,
     current_data_needed=True,
+    priority=None,
+    outputsize="full",
 ):
     """
     Fetch stock data from Alpha Vantage API.
@@ -25,34 +193,38 @@ def get_stock_data(
         month: Optional month for historical data (format: 'YYYY-MM')
         daily_data_needed: Whether to fetch daily price data
         intraday_data_needed: Whether to fetch intraday price data
+        priority: Optional rate limiter lane, defaults to one based on the data type
+        outputsize: 'full' for the whole series or 'compact' for the latest 100 bars
 
     Returns:
         Tuple containing the requested data and stock symbol
     """
     try:
-        # Construct intraday API URL based on whether month is specified
-        if month:
-            intraday_url = f"{BASE_URL}function=TIME_SERIES_INTRADAY&symbol={stock_symbol}&interval=1min&month={month}&outputsize=full&entitlement=delayed&extended_hours=false&apikey={API_KEY}"
-        else:
-            intraday_url = f"{BASE_URL}function=TIME_SERIES_INTRADAY&symbol={stock_symbol}&interval=1min&outputsize=full&entitlement=delayed&extended_hours=false&apikey={API_KEY}"
-
         # Handle different combinations of data requests
         if current_data_needed:
             quote_url = f"{BASE_URL}function=GLOBAL_QUOTE&symbol={stock_symbol}&entitlement=delayed&apikey={API_KEY}"
-            quote_response = requests.get(quote_url)
-            quote_data = quote_response.json()
+            quote_data = fetch_api_json(
+                quote_url,
+                stock_symbol,
+                PRIORITY_CURRENT if priority is None else priority,
+            )
             return quote_data, stock_symbol
 
         elif daily_data_needed:
-            daily_url = f"{BASE_URL}function=TIME_SERIES_DAILY_ADJUSTED&symbol={stock_symbol}&outputsize=full&apikey={API_KEY}"
-            daily_response = requests.get(daily_url)
-            daily_data = daily_response.json()
+            daily_data = fetch_api_json(
+                get_daily_url(stock_symbol, outputsize),
+                stock_symbol,
+                PRIORITY_BACKFILL if priority is None else priority,
+            )
 
             return daily_data, stock_symbol
 
         elif intraday_data_needed:
-            intraday_response = requests.get(intraday_url)
-            intraday_data = intraday_response.json()
+            intraday_data = fetch_api_json(
+                get_intraday_url(stock_symbol, month, outputsize),
+                stock_symbol,
+                PRIORITY_INTRADAY if priority is None else priority,
+            )
 
             return intraday_data, stock_symbol
 
@@ -61,18 +233,49 @@ def get_stock_data(
         return None, stock_symbol
 
 
+def get_stock_data_batch(
+    stock_symbols, month=None, max_workers=MAX_FETCH_WORKERS, **kwargs
+):
+    """
+    Fetch stock data for many symbols concurrently.
+
+    Requests share the pooled keep-alive session and results are yielded as
+    soon as each one completes, so callers can start writing to the database
+    before the slowest symbol arrives.
+
+    Args:
+        stock_symbols: List of stock ticker symbols to fetch
+        month: Optional month for historical data (format: 'YYYY-MM')
+        max_workers: Maximum number of requests in flight at once
+        **kwargs: Data selection flags and priority passed through to get_stock_data
+
+    Yields:
+        Tuples of (data, stock_symbol) in completion order
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(get_stock_data, symbol, month, **kwargs)
+            for symbol in stock_symbols
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def get_quote_timestamp(latest_trading_day):
+    """Label a delayed quote with its time, or the last close outside market hours"""
+    current_datetime = datetime.now() - timedelta(minutes=15)
+    current_time = current_datetime.time()
+
+    if current_time < time(9, 30) or current_time > time(16, 0):
+        return f"{latest_trading_day}  4:00:00 PM"
+    return current_datetime.strftime("%Y-%m-%d %I:%M:%S %p")
+
+
 def process_current_stock_data(quote_data, stock_symbol):
     """Process raw quote data into current stock information."""
     try:
         quote = quote_data["Global Quote - DATA DELAYED BY 15 MINUTES"]
 
-        current_datetime = datetime.now() - timedelta(minutes=15)
-        latest_timestamp = current_datetime.strftime("%Y-%m-%d %I:%M:%S %p")
-        current_time = current_datetime.time()
-
-        if current_time < time(9, 30) or current_time > time(16, 0):
-            latest_timestamp = f"{quote['07. latest trading day']}  4:00:00 PM"
-
         return {
             "stock_symbol": stock_symbol,
             "open_price": round(float(quote["02. open"]), 2),
@@ -80,7 +283,7 @@ def process_current_stock_data(quote_data, stock_symbol):
             "low_price": round(float(quote["04. low"]), 2),
             "price": round(float(quote["05. price"]), 2),
             "volume": int(quote["06. volume"]),
-            "latest_timestamp": latest_timestamp,
+            "latest_timestamp": get_quote_timestamp(quote["07. latest trading day"]),
             "previous_close": round(float(quote["08. previous close"]), 2),
             "change": round(float(quote["09. change"]), 2),
             "change_percent": str(
@@ -93,6 +296,108 @@ def process_current_stock_data(quote_data, stock_symbol):
         return None
 
 
+def process_bulk_quote(quote):
+    """Process one entry of a REALTIME_BULK_QUOTES response like a GLOBAL_QUOTE"""
+    try:
+        return {
+            "stock_symbol": quote["symbol"].upper(),
+            "open_price": round(float(quote["open"]), 2),
+            "high_price": round(float(quote["high"]), 2),
+            "low_price": round(float(quote["low"]), 2),
+            "price": round(float(quote["close"]), 2),
+            "volume": int(float(quote["volume"])),
+            "latest_timestamp": get_quote_timestamp(quote["timestamp"][:10]),
+            "previous_close": round(float(quote["previous_close"]), 2),
+            "change": round(float(quote["change"]), 2),
+            "change_percent": str(
+                round(float(str(quote["change_percent"]).strip("%")), 2)
+            )
+            + "%",
+        }
+    except Exception as e:
+        print(f"Error processing bulk quote {quote.get('symbol')}: {e}")
+        return None
+
+
+def get_bulk_quotes(stock_symbols, priority=PRIORITY_CURRENT):
+    """
+    Fetch quotes for up to BULK_QUOTE_BATCH_SIZE symbols in one API call.
+
+    Args:
+        stock_symbols: List of stock ticker symbols
+        priority: Rate limiter lane for the call
+
+    Returns:
+        List of processed quotes, or None if the plan has no bulk quote access
+
+    Raises:
+        ApiError: If the call was throttled, refused or answered unexpectedly
+        requests.RequestException: If the request itself failed
+    """
+    symbols = ",".join(stock_symbols)
+    bulk_url = f"{BASE_URL}function=REALTIME_BULK_QUOTES&symbol={symbols}&entitlement=delayed&apikey={API_KEY}"
+
+    try:
+        bulk_data = fetch_api_json(bulk_url, symbols, priority, raise_errors=True)
+    except ApiError as e:
+        # Plans without the endpoint get a premium message instead of data
+        if PREMIUM_ENDPOINT_MESSAGE in str(e).lower():
+            return None
+        raise
+
+    if not isinstance(bulk_data.get("data"), list):
+        raise ApiError(f"Unexpected bulk quote response for {symbols}")
+
+    quotes = [process_bulk_quote(quote) for quote in bulk_data["data"]]
+    return [quote for quote in quotes if quote]
+
+
+def get_current_quotes(stock_symbols):
+    """
+    Fetch current quotes for many symbols with as few API calls as possible.
+
+    Symbols are quoted in batches through REALTIME_BULK_QUOTES. Symbols a
+    batch did not return, or all of them if the plan has no bulk access,
+    fall back to one GLOBAL_QUOTE call each. Once the API has said the plan
+    does not include the bulk endpoint it is not tried again until restart;
+    a batch that fails for any other reason only falls back this time.
+
+    Args:
+        stock_symbols: List of stock ticker symbols
+
+    Returns:
+        List of processed quote dictionaries, one per symbol that was quoted
+    """
+    global USE_BULK_QUOTES
+    quotes = {}
+
+    if USE_BULK_QUOTES:
+        for start in range(0, len(stock_symbols), BULK_QUOTE_BATCH_SIZE):
+            batch = stock_symbols[start : start + BULK_QUOTE_BATCH_SIZE]
+            try:
+                bulk_quotes = get_bulk_quotes(batch)
+            except Exception as e:
+                print(f"Error getting bulk quotes, quoting the batch one by one: {e}")
+                continue
+            if bulk_quotes is None:
+                print("Bulk quotes are not in the API plan, using one call per symbol")
+                USE_BULK_QUOTES = False
+                break
+            for quote in bulk_quotes:
+                quotes[quote["stock_symbol"]] = quote
+
+    missing = [symbol for symbol in stock_symbols if symbol.upper() not in quotes]
+    for quote_data, symbol in get_stock_data_batch(
+        missing, daily_data_needed=False, intraday_data_needed=False
+    ):
+        if quote_data:
+            quote = process_current_stock_data(quote_data, symbol)
+            if quote:
+                quotes[symbol.upper()] = quote
+
+    return list(quotes.values())
+
+
 def process_daily_price_history(daily_data, stock_symbol, date):
     """
     Process raw API data into daily historical prices.
@@ -123,6 +428,51 @@ def process_daily_price_history(daily_data, stock_symbol, date):
         return None
 
 
+def daily_bar_row(stock_symbol, date, bar):
+    """
+    Build a price_history row from one daily bar.
+
+    Open, high and low are scaled by the same split/dividend factor as the
+    adjusted close so the stored bar is consistent.
+    """
+    close_price = float(bar["4. close"])
+    adjusted_close = float(bar["5. adjusted close"])
+    factor = adjusted_close / close_price if close_price else 1.0
+
+    return (
+        stock_symbol,
+        timestamp_to_epoch(date + " 16:00:00"),  # Market close time
+        round(float(bar["1. open"]) * factor, 2),
+        round(float(bar["2. high"]) * factor, 2),
+        round(float(bar["3. low"]) * factor, 2),
+        round(adjusted_close, 2),
+        int(bar["6. volume"]),
+    )
+
+
+def process_daily_time_series(daily_data, stock_symbol):
+    """
+    Convert a full daily API response into price_history rows in one pass.
+
+    Args:
+        daily_data: JSON response from daily API endpoint
+        stock_symbol: Stock ticker symbol
+
+    Returns:
+        List of price_history rows in PRICE_HISTORY_COLUMNS order
+    """
+    try:
+        time_series = daily_data["Time Series (Daily)"]
+
+        return [
+            daily_bar_row(stock_symbol, date, bar) for date, bar in time_series.items()
+        ]
+
+    except Exception as e:
+        print(f"Error processing data for {stock_symbol}: {e}")
+        return []
+
+
 def process_intraday_price_history(intraday_data, stock_symbol, timestamp):
     """
     Process raw API data into intraday historical prices.
@@ -153,5 +503,144 @@ def process_intraday_price_history(intraday_data, stock_symbol, timestamp):
         return None
 
 
+def intraday_bar_row(stock_symbol, timestamp, bar):
+    """Build a price_history row from one intraday bar"""
+    return (
+        stock_symbol,
+        timestamp_to_epoch(timestamp),
+        round(float(bar["1. open"]), 2),
+        round(float(bar["2. high"]), 2),
+        round(float(bar["3. low"]), 2),
+        round(float(bar["4. close"]), 2),
+        int(bar["5. volume"]),
+    )
+
+
+def process_intraday_time_series(intraday_data, stock_symbol):
+    """
+    Convert a full intraday API response into price_history rows in one pass.
+
+    Args:
+        intraday_data: JSON response from intraday API endpoint
+        stock_symbol: Stock ticker symbol
+
+    Returns:
+        List of price_history rows in PRICE_HISTORY_COLUMNS order
+    """
+    try:
+        time_series = intraday_data["Time Series (1min)"]
+
+        return [
+            intraday_bar_row(stock_symbol, timestamp, bar)
+            for timestamp, bar in time_series.items()
+        ]
+
+    except Exception as e:
+        print(f"Error processing data for {stock_symbol}: {e}")
+        return []
+
+
+def iter_time_series_rows(json_file, stock_symbol, daily=False):
+    """
+    Parse a time series response incrementally, one bar at a time.
+
+    Uses ijson when it is installed so only the current bar is held in
+    memory; without it the whole response is decoded first.
+
+    Args:
+        json_file: Binary file-like object with the JSON response
+        stock_symbol: Stock ticker symbol
+        daily: True for a daily response, False for a 1-minute intraday one
+
+    Yields:
+        price_history rows in PRICE_HISTORY_COLUMNS order, in response order
+
+    Raises:
+        ApiError: If the response is a throttling or error message, or has
+            no time series at all
+    """
+    if daily:
+        series_key, build_row = "Time Series (Daily)", daily_bar_row
+    else:
+        series_key, build_row = "Time Series (1min)", intraday_bar_row
+
+    # Throttled and invalid requests come back as a message key instead of
+    # the series, which would otherwise look like a month without bars
+    if ijson is None:
+        data = json.load(json_file)
+        message_keys = [key for key in API_MESSAGE_KEYS if key in data]
+        if message_keys:
+            message = data[message_keys[0]]
+            raise ApiError(f"API returned no data for {stock_symbol}: {message}")
+        if series_key not in data:
+            raise ApiError(f"API response for {stock_symbol} has no {series_key}")
+        bars = data[series_key].items()
+    else:
+        # Read up to the first top-level key, then stream on from there
+        events = ijson.parse(json_file)
+        head = []
+        for event in events:
+            head.append(event)
+            if event[:2] == ("", "map_key"):
+                break
+        if head and head[-1][2] in API_MESSAGE_KEYS:
+            message = next(events, (None, None, ""))[2]
+            raise ApiError(f"API returned no data for {stock_symbol}: {message}")
+        series_seen = False
+
+        def watch_series(events):
+            nonlocal series_seen
+            for event in events:
+                if event == ("", "map_key", series_key):
+                    series_seen = True
+                yield event
+
+        bars = ijson.kvitems(watch_series(chain(head, events)), series_key)
+
+    for timestamp, bar in bars:
+        yield build_row(stock_symbol, timestamp, bar)
+
+    # An unexpected body without the series must not pass for an empty month
+    if ijson is not None and not series_seen:
+        raise ApiError(f"API response for {stock_symbol} has no {series_key}")
+
+
+def stream_time_series(
+    stock_symbol, month=None, daily=False, priority=None, outputsize="full"
+):
+    """
+    Fetch a price history series and yield its bars as they are downloaded.
+
+    Request errors, API messages and a refusal by the rate limiter are
+    raised to the caller, so a failed or partly streamed series is never
+    mistaken for a complete one.
+
+    Args:
+        stock_symbol: The stock ticker symbol (e.g., 'AAPL')
+        month: Optional month for intraday data (format: 'YYYY-MM')
+        daily: Fetch daily bars instead of 1-minute intraday bars
+        priority: Optional rate limiter lane, defaults to one based on the data type
+        outputsize: 'full' for the whole series or 'compact' for the latest 100 bars
+
+    Yields:
+        price_history rows in PRICE_HISTORY_COLUMNS order, newest first
+    """
+    if daily:
+        url = get_daily_url(stock_symbol, outputsize)
+        lane = PRIORITY_BACKFILL if priority is None else priority
+    else:
+        url = get_intraday_url(stock_symbol, month, outputsize)
+        lane = PRIORITY_INTRADAY if priority is None else priority
+
+    if not api_rate_limiter.acquire(lane):
+        raise ApiError(f"Daily API call limit reached, skipped {stock_symbol}")
+
+    with http_session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        # Let urllib3 undo any gzip encoding while the parser reads the body
+        response.raw.decode_content = True
+        yield from iter_time_series_rows(response.raw, stock_symbol, daily)
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,119 @@
+# symbol_loader.py
+# Fetches the first quote and intraday bars of a symbol nobody has viewed yet,
+# once per symbol no matter how many requests ask for it at the same time
+
+import threading
+from collections import OrderedDict
+from time import time
+from database import update_current_stock_data, sync_intraday_price_history
+from symbol_registry import SYMBOL_PATTERN, claim_first_load
+
+# Seconds a page request waits for a new symbol's quote before rendering
+# without it; the page fills in when the quote arrives over the live stream
+FIRST_LOAD_WAIT_SECONDS = 10
+
+# Seconds before a symbol the API returned no quote for is tried again, so
+# mistyped symbols do not spend an API call on every page load
+FAILED_RETRY_SECONDS = 5 * 60
+
+# Most symbols remembered as failed, the oldest are forgotten first
+MAX_FAILED_SYMBOLS = 1000
+
+# Most first loads running at once; further symbols are not fetched until
+# one finishes
+MAX_CONCURRENT_LOADS = 2
+
+
+class SymbolLoader:
+    """
+    Single-flight loader for symbols without stored data.
+
+    The first request for a symbol starts one background fetch; every
+    request for it while that fetch runs waits on the same event instead of
+    making its own API calls. The event is set as soon as the quote is
+    stored, and the intraday bars follow in the background, reaching open
+    charts through the usual 'bars' update. Fetches are limited in number
+    at any one time and per day, see claim_first_load.
+    """
+
+    def __init__(self):
+        self.loading = {}  # symbol -> event set once its quote is stored
+        self.failed = OrderedDict()  # symbol -> time its quote came back empty
+        self.lock = threading.Lock()
+
+    def load(self, symbol, timeout=FIRST_LOAD_WAIT_SECONDS):
+        """
+        Fetch a symbol's quote if no fetch is running, and wait for it.
+
+        Args:
+            symbol: Stock ticker symbol without stored data
+            timeout: Seconds to wait for the quote
+
+        Returns:
+            True once the quote fetch has finished, False if it is still
+            running, the symbol is invalid, it failed recently or no fetch
+            could be started within the limits
+        """
+        if not SYMBOL_PATTERN.match(symbol):
+            return False
+
+        with self.lock:
+            self.forget_failures()
+            if symbol in self.failed:
+                return False
+
+            quote_ready = self.loading.get(symbol)
+            starting = quote_ready is None
+            if starting:
+                if len(self.loading) >= MAX_CONCURRENT_LOADS:
+                    return False
+                quote_ready = threading.Event()
+                self.loading[symbol] = quote_ready
+
+        if starting:
+            # Claimed outside the lock, the claim waits for the writer
+            if not claim_first_load(symbol):
+                print(f"First load budget used up, not fetching {symbol}")
+                with self.lock:
+                    self.loading.pop(symbol, None)
+                quote_ready.set()
+                return False
+
+            threading.Thread(
+                target=self.fetch, args=(symbol, quote_ready), daemon=True
+            ).start()
+
+        return quote_ready.wait(timeout)
+
+    def forget_failures(self):
+        """Drop failures old enough to retry, and the oldest beyond the cap"""
+        now = time()
+        while self.failed and (
+            len(self.failed) > MAX_FAILED_SYMBOLS
+            or now - next(iter(self.failed.values())) >= FAILED_RETRY_SECONDS
+        ):
+            self.failed.popitem(last=False)
+
+    def fetch(self, symbol, quote_ready):
+        """Fetch and store the quote, then the current month of intraday bars"""
+        try:
+            if not update_current_stock_data([symbol]):
+                print(f"No quote available for {symbol}")
+                with self.lock:
+                    self.failed.pop(symbol, None)
+                    self.failed[symbol] = time()
+                return
+
+            # Let waiting pages render while the bars are fetched
+            quote_ready.set()
+            sync_intraday_price_history([symbol])
+        except Exception as e:
+            print(f"Error loading data for {symbol}: {e}")
+        finally:
+            quote_ready.set()
+            with self.lock:
+                self.loading.pop(symbol, None)
+
+
+# Shared loader used by the stock page
+symbol_loader = SymbolLoader()
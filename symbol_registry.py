@@ -0,0 +1,273 @@
+# symbol_registry.py
+# Decides which symbols the scheduler keeps up to date and how often,
+# based on what users hold and view, within the API call budget
+
+import re
+import threading
+from time import time
+from database import create_connection
+from stock_data import (
+    CALLS_PER_MINUTE,
+    CALLS_PER_DAY,
+    BULK_QUOTE_BATCH_SIZE,
+)
+import stock_data
+
+# Seconds between scheduled refresh ticks
+REFRESH_TICK_SECONDS = 60
+
+# Share of the API budget given to scheduled refreshes
+REFRESH_BUDGET_SHARE = 0.8
+
+# Share of the API budget given to first loads of symbols nobody has viewed
+# yet; what neither share uses is left for daily history updates
+FIRST_LOAD_BUDGET_SHARE = 0.1
+
+# API calls one first load spends: the quote and the current month of bars
+FIRST_LOAD_COST = 2
+
+# How recently a symbol must have been viewed to count as hot, warm or cold;
+# symbols not viewed for longer are dropped unless held or pinned
+HOT_VIEW_SECONDS = 15 * 60
+WARM_VIEW_SECONDS = 24 * 60 * 60
+COLD_VIEW_SECONDS = 7 * 24 * 60 * 60
+
+# Ticks between refreshes for each tier, from fastest to slowest. Symbols
+# are moved to slower tiers when the faster ones would exceed the budget.
+REFRESH_TIERS = (("hot", 1), ("warm", 5), ("cold", 30), ("background", 240))
+
+# Views of a symbol are written at most this often, page loads in between
+# only update memory
+VIEW_WRITE_SECONDS = 60
+
+# Ticker symbols accepted into the registry (e.g. 'AAPL', 'BRK.B')
+SYMBOL_PATTERN = re.compile(r"^[A-Z][A-Z0-9.\-]{0,9}$")
+
+view_writes = {}  # symbol -> time its last view was written
+view_lock = threading.Lock()
+
+# Symbols left out of the last refresh plan, so the warning is printed once
+skipped_symbols = []
+
+
+def record_view(stock_symbol):
+    """
+    Note that a symbol was viewed so it gets tracked, throttled per symbol.
+
+    Args:
+        stock_symbol: Stock ticker symbol that was viewed
+    """
+    if not SYMBOL_PATTERN.match(stock_symbol):
+        return
+
+    now = time()
+    with view_lock:
+        if now - view_writes.get(stock_symbol, 0) < VIEW_WRITE_SECONDS:
+            return
+        view_writes[stock_symbol] = now
+
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(
+            """
+        INSERT INTO tracked_symbols (stock_symbol, last_viewed, view_count)
+            VALUES (?, ?, 1)
+            ON CONFLICT(stock_symbol) DO UPDATE
+            SET last_viewed = excluded.last_viewed, view_count = view_count + 1
+        """,
+            (stock_symbol, int(now)),
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def get_symbol_demand():
+    """
+    Collect every symbol that is held, pinned or was viewed recently.
+
+    Symbols whose last view is older than COLD_VIEW_SECONDS and that are not
+    pinned are removed from the registry.
+
+    Returns:
+        Dictionary of symbol to (held, pinned, last_viewed)
+    """
+    cutoff = int(time()) - COLD_VIEW_SECONDS
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(
+            """DELETE FROM tracked_symbols
+            WHERE pinned = 0 AND COALESCE(last_viewed, 0) < ?""",
+            (cutoff,),
+        )
+        connection.commit()
+
+        cursor.execute(
+            """
+        SELECT stock_symbol, 0, pinned, last_viewed FROM tracked_symbols
+        UNION ALL
+        SELECT DISTINCT stock_symbol, 1, 0, NULL FROM portfolios WHERE shares > 0
+        """
+        )
+        rows = cursor.fetchall()
+    finally:
+        connection.close()
+
+    demand = {}
+    for symbol, held, pinned, last_viewed in rows:
+        previous = demand.get(symbol, (0, 0, None))
+        demand[symbol] = (
+            previous[0] or held,
+            previous[1] or pinned,
+            last_viewed if last_viewed is not None else previous[2],
+        )
+    return demand
+
+
+def get_refresh_budget():
+    """
+    Work out how many API calls one refresh tick may spend on average.
+
+    Returns:
+        Calls per tick allowed by the per-minute and per-day plan limits
+    """
+    budget = CALLS_PER_MINUTE * REFRESH_TICK_SECONDS / 60
+    if CALLS_PER_DAY:
+        ticks_per_day = 24 * 60 * 60 / REFRESH_TICK_SECONDS
+        budget = min(budget, CALLS_PER_DAY / ticks_per_day)
+    return budget * REFRESH_BUDGET_SHARE
+
+
+def get_first_load_budget():
+    """
+    Work out how many first loads fit in a day of the API budget.
+
+    Returns:
+        First loads allowed per day by the per-minute and per-day plan limits
+    """
+    calls = CALLS_PER_MINUTE * 24 * 60
+    if CALLS_PER_DAY:
+        calls = min(calls, CALLS_PER_DAY)
+    return int(calls * FIRST_LOAD_BUDGET_SHARE / FIRST_LOAD_COST)
+
+
+def claim_first_load(stock_symbol):
+    """
+    Count a first load of a symbol against the budget, if it still fits.
+
+    First loads are recorded in the database so every web process draws on
+    the same daily allowance.
+
+    Args:
+        stock_symbol: Stock ticker symbol about to be fetched
+
+    Returns:
+        True if the first load may go ahead, False if the budget is used up
+    """
+    now = int(time())
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(
+            """DELETE FROM first_loads WHERE loaded_at < ?""", (now - 24 * 60 * 60,)
+        )
+        cursor.execute("""SELECT COUNT(*) FROM first_loads""")
+        allowed = cursor.fetchone()[0] < get_first_load_budget()
+        if allowed:
+            cursor.execute(
+                """INSERT INTO first_loads (stock_symbol, loaded_at) VALUES (?, ?)""",
+                (stock_symbol, now),
+            )
+        connection.commit()
+        return allowed
+    finally:
+        connection.close()
+
+
+def get_demand_tier(held, pinned, last_viewed, now):
+    """Return the index in REFRESH_TIERS a symbol's demand asks for"""
+    age = now - last_viewed if last_viewed is not None else None
+    if held or (age is not None and age <= HOT_VIEW_SECONDS):
+        return 0
+    if pinned or (age is not None and age <= WARM_VIEW_SECONDS):
+        return 1
+    return 2
+
+
+def assign_refresh_tiers():
+    """
+    Give every tracked symbol a refresh interval that fits the API budget.
+
+    Symbols are ranked by demand: held first, then by how recently they
+    were viewed. In that order each one gets the fastest tier its demand
+    asks for that still fits the remaining budget, falling back to slower
+    tiers. Symbols that do not fit even the slowest tier are left out
+    until demand or budget changes.
+
+    Returns:
+        Dictionary of symbol to ticks between refreshes, in priority order
+    """
+    now = time()
+    demand = get_symbol_demand()
+
+    # One intraday call per symbol, compact or a full month for slow tiers
+    # whose gap outgrows the compact output (a second one on the first sync
+    # after a month boundary), plus its share of a quote call
+    quote_cost = 1 / BULK_QUOTE_BATCH_SIZE if stock_data.USE_BULK_QUOTES else 1
+    symbol_cost = 1 + quote_cost
+
+    ranked = sorted(
+        demand.items(),
+        key=lambda item: (
+            get_demand_tier(*item[1], now),
+            -item[1][0],
+            -(item[1][2] or 0),
+            item[0],
+        ),
+    )
+
+    remaining = get_refresh_budget()
+    intervals = {}
+    skipped = []
+    for symbol, (held, pinned, last_viewed) in ranked:
+        tier = get_demand_tier(held, pinned, last_viewed, now)
+        for _, interval in REFRESH_TIERS[tier:]:
+            if symbol_cost / interval <= remaining:
+                intervals[symbol] = interval
+                remaining -= symbol_cost / interval
+                break
+        else:
+            skipped.append(symbol)
+
+    global skipped_symbols
+    if skipped and skipped != skipped_symbols:
+        print(f"API budget too small to refresh {len(skipped)} symbols: {skipped}")
+    skipped_symbols = skipped
+    return intervals
+
+
+def get_due_symbols(tick):
+    """
+    Pick the symbols to refresh on a scheduler tick.
+
+    Symbols sharing an interval are spread across ticks so the calls are
+    not all made on the same one.
+
+    Args:
+        tick: Number of the tick, counting up from 0
+
+    Returns:
+        List of symbols to refresh now, highest demand first
+    """
+    due = []
+    position = {}
+    for symbol, interval in assign_refresh_tiers().items():
+        offset = position.get(interval, 0)
+        position[interval] = offset + 1
+        if (tick + offset) % interval == 0:
+            due.append(symbol)
+    return due
+
+
+def get_tracked_symbols():
+    """Return every held, pinned or recently viewed symbol, for daily history"""
+    return list(get_symbol_demand())
@@ -0,0 +1,255 @@
+# timeseries_store.py
+# In-memory columnar price history per symbol, kept in step with price_history
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from stock_data import MARKET_OPEN_MINUTE, MARKET_CLOSE_MINUTE
+
+# Upper bound on the memory held by cached price series
+TIMESERIES_MAX_BYTES = 256 * 1024 * 1024
+
+
+def reduce_segments(ufunc, values, starts, ends):
+    """
+    Apply a ufunc over values[start:end] for each pair of bounds.
+
+    Args:
+        ufunc: NumPy ufunc such as np.maximum or np.add
+        values: Array to reduce
+        starts: Sorted segment start indices
+        ends: Segment end indices, each segment non-empty and not overlapping
+
+    Returns:
+        Array with one reduced value per segment
+    """
+    if not len(starts):
+        return values[:0]
+
+    # reduceat over start/end pairs reduces each segment and each gap between
+    # them, a trailing element keeps the final end index in range
+    bounds = np.column_stack((starts, ends)).ravel()
+    return ufunc.reduceat(np.append(values, values[:1]), bounds)[::2]
+
+
+class PriceSeries:
+    """
+    Bars of one symbol as parallel NumPy arrays sorted by timestamp.
+
+    Series are never modified in place: merging and slicing return new
+    series (slices are views), so readers can keep using a series while a
+    writer swaps in a newer one.
+    """
+
+    def __init__(self, ts, open_price, high_price, low_price, close_price, volume):
+        self.ts = ts
+        self.open = open_price
+        self.high = high_price
+        self.low = low_price
+        self.close = close_price
+        self.volume = volume
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a series from (ts, open, high, low, close, volume) rows.
+
+        Missing open, high and low fall back to the close, missing volume to 0.
+        """
+        data = np.array(rows, dtype=np.float64).reshape(-1, 6)
+        close_price = data[:, 4]
+        columns = [
+            np.where(np.isnan(data[:, column]), close_price, data[:, column])
+            for column in (1, 2, 3)
+        ]
+        return cls(
+            data[:, 0].astype(np.int64),
+            *columns,
+            close_price,
+            np.nan_to_num(data[:, 5]).astype(np.int64),
+        )
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns())
+
+    def columns(self):
+        return (self.ts, self.open, self.high, self.low, self.close, self.volume)
+
+    def take(self, selector):
+        """Return the bars picked by a slice, index array or boolean mask"""
+        return PriceSeries(*(column[selector] for column in self.columns()))
+
+    def between(self, start_ts, end_ts):
+        """Return a view of the bars with start_ts <= ts <= end_ts"""
+        start = np.searchsorted(self.ts, start_ts, side="left")
+        end = np.searchsorted(self.ts, end_ts, side="right")
+        return self.take(slice(start, end))
+
+    def market_hours(self):
+        """Return the bars inside regular market hours, as charts use"""
+        minutes = (self.ts % 86400) // 60
+        return self.take(
+            (minutes >= MARKET_OPEN_MINUTE) & (minutes <= MARKET_CLOSE_MINUTE)
+        )
+
+    def resample(self, interval_minutes):
+        """
+        Aggregate market-hours bars into OHLCV buckets.
+
+        Buckets start at ts - ts % span, open and close come from the first
+        and last bar, high and low are the extremes and volume is summed.
+
+        Args:
+            interval_minutes: Bucket width in minutes
+
+        Returns:
+            PriceSeries with one bar per bucket, timestamped at its start
+        """
+        if not len(self):
+            return self
+
+        # Every bucket lies within one day, clip it to that day's market hours
+        span = interval_minutes * 60
+        buckets = np.arange(self.ts[0] - self.ts[0] % span, self.ts[-1] + 1, span)
+        days = buckets - buckets % 86400
+        lows = np.maximum(buckets, days + MARKET_OPEN_MINUTE * 60)
+        highs = np.minimum(buckets + span - 1, days + MARKET_CLOSE_MINUTE * 60)
+
+        # Binary search for each bucket's bars instead of scanning every bar
+        starts = np.searchsorted(self.ts, lows, side="left")
+        ends = np.searchsorted(self.ts, highs, side="right")
+        filled = ends > starts
+        buckets, starts, ends = buckets[filled], starts[filled], ends[filled]
+
+        return PriceSeries(
+            buckets,
+            self.open[starts],
+            reduce_segments(np.maximum, self.high, starts, ends),
+            reduce_segments(np.minimum, self.low, starts, ends),
+            self.close[ends - 1],
+            reduce_segments(np.add, self.volume, starts, ends),
+        )
+
+    def merge(self, other, replace=True):
+        """
+        Combine two series, resolving bars with the same timestamp.
+
+        Args:
+            other: Series with the new bars
+            replace: Keep the new bar on a clash instead of the existing one
+
+        Returns:
+            New PriceSeries sorted by timestamp
+        """
+        pairs = zip(self.columns(), other.columns())
+        combined = PriceSeries(*(np.concatenate(pair) for pair in pairs))
+
+        # Appending newer bars, the common case, needs no sort
+        if not len(self) or not len(other) or other.ts[0] > self.ts[-1]:
+            return combined
+
+        order = np.argsort(combined.ts, kind="stable")
+        ts = combined.ts[order]
+        same = ts[1:] == ts[:-1]
+
+        # Stable sort keeps existing bars before new ones with the same timestamp
+        if replace:
+            keep = np.r_[~same, True]
+        else:
+            keep = np.r_[True, ~same]
+        return combined.take(order[keep])
+
+
+class TimeSeriesStore:
+    """
+    LRU cache of PriceSeries keyed by symbol.
+
+    Series are loaded lazily by the caller and stored with put(); the ingest
+    path calls append() after committing bars so loaded series stay current.
+    A per-symbol generation counter, as in the chart cache, stops a series
+    read before a write from being stored after it.
+    """
+
+    def __init__(self, max_bytes=TIMESERIES_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # symbol -> PriceSeries
+        self.generations = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def generation(self, symbol):
+        """Return the symbol's generation, taken before loading a series"""
+        with self.lock:
+            return self.generations.get(symbol, 0)
+
+    def get(self, symbol):
+        """Return the cached series for a symbol, or None if not loaded"""
+        with self.lock:
+            series = self.entries.get(symbol)
+            if series is not None:
+                self.entries.move_to_end(symbol)
+            return series
+
+    def put(self, symbol, series, generation):
+        """Store a loaded series unless bars were written while it was read"""
+        with self.lock:
+            if self.generations.get(symbol, 0) != generation:
+                return
+            self.store(symbol, series)
+
+    def store(self, symbol, series):
+        """Swap in a series and evict old ones, the lock must be held"""
+        previous = self.entries.pop(symbol, None)
+        if previous is not None:
+            self.size -= previous.nbytes
+
+        self.entries[symbol] = series
+        self.size += series.nbytes
+
+        # Evict least recently used symbols, always keeping the newest one
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def append(self, symbol, rows, replace=True):
+        """
+        Merge committed price_history rows into a loaded series.
+
+        Args:
+            symbol: Stock ticker symbol
+            rows: price_history rows in PRICE_HISTORY_COLUMNS order
+            replace: Whether the rows overwrote existing bars
+        """
+        with self.lock:
+            self.generations[symbol] = self.generations.get(symbol, 0) + 1
+            series = self.entries.get(symbol)
+            if series is None:
+                return
+
+            new_bars = PriceSeries.from_rows([row[1:] for row in rows])
+            order = np.argsort(new_bars.ts, kind="stable")
+            self.store(symbol, series.merge(new_bars.take(order), replace))
+
+    def invalidate(self, symbol):
+        """Drop a symbol's series so it is reloaded on next use"""
+        with self.lock:
+            self.generations[symbol] = self.generations.get(symbol, 0) + 1
+            series = self.entries.pop(symbol, None)
+            if series is not None:
+                self.size -= series.nbytes
+
+    def clear(self):
+        """Drop every cached series"""
+        with self.lock:
+            for symbol in set(self.generations) | set(self.entries):
+                self.generations[symbol] = self.generations.get(symbol, 0) + 1
+            self.entries.clear()
+            self.size = 0
+
+
+# Shared store read by the web app and appended to by the database writers
+timeseries_store = TimeSeriesStore()
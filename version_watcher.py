@@ -0,0 +1,155 @@
+# version_watcher.py
+# Follows the data_versions table so a web process's caches and live update
+# streams stay in step with bars and quotes written by the ingest worker
+
+import sqlite3
+import threading
+from time import sleep
+import database
+from database import create_connection, notify_bars_stored
+from chart_cache import chart_cache
+from timeseries_store import timeseries_store
+from live_updates import live_updates
+
+# Seconds between checks for new writes
+VERSION_POLL_SECONDS = 2
+
+# Keys of the quote updates sent to browsers, in stocks_current column order
+QUOTE_KEYS = (
+    "stock_symbol",
+    "open_price",
+    "high_price",
+    "low_price",
+    "price",
+    "volume",
+    "latest_timestamp",
+    "previous_close",
+    "change",
+    "change_percent",
+)
+
+
+class VersionWatcher:
+    """
+    Background poller of data_versions for a process that does not ingest.
+
+    A bars version one ahead of the last one seen is caught up by reading
+    the bars from that write's changed_from onward and merging them into
+    the in-memory series, as the ingest process does after writing. Larger
+    jumps, such as several streamed chunks, drop the series so it is
+    reloaded. Quote versions push the stored quote to streaming clients.
+    Versions written by this process itself are skipped, its caches and
+    streams were updated when it wrote them.
+    """
+
+    def __init__(self, poll_seconds=VERSION_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.versions = {}  # scope -> version last handled
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start polling in a daemon thread, once per process"""
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            # Writes made before startup are already in the database
+            self.versions = {
+                scope: version for scope, version, _ in self.read_versions()
+            }
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            sleep(self.poll_seconds)
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error following data versions: {e}")
+
+    def read_versions(self):
+        connection, cursor = create_connection()
+        try:
+            # Range seeks on the primary key, portfolio scopes are not followed
+            cursor.execute(
+                """
+            SELECT scope, version, changed_from FROM data_versions
+            WHERE (scope >= 'bars:' AND scope < 'bars;')
+            OR (scope >= 'quote:' AND scope < 'quote;')
+            """
+            )
+            return cursor.fetchall()
+        except sqlite3.OperationalError:
+            # The worker has not created the table yet, nothing to follow
+            return []
+        finally:
+            connection.close()
+
+    def poll(self):
+        """Handle every scope whose version changed since the last poll"""
+        for scope, version, changed_from in self.read_versions():
+            seen = self.versions.get(scope, 0)
+            if version == seen:
+                continue
+            self.versions[scope] = version
+
+            # Every version since the last poll was written by this process
+            first, last = database.local_versions.get(scope, (None, None))
+            if last == version and first <= seen + 1:
+                continue
+
+            kind, _, symbol = scope.partition(":")
+            if kind == "bars":
+                self.follow_bars(symbol, version - seen == 1, changed_from)
+            elif kind == "quote":
+                self.follow_quote(symbol)
+
+    def follow_bars(self, symbol, single_write, changed_from):
+        """Bring the symbol's cached series and charts up to date"""
+        if (
+            single_write
+            and changed_from is not None
+            and database.PRICE_HISTORY_BACKEND == "sqlite"
+            and timeseries_store.get(symbol) is not None
+        ):
+            connection, cursor = create_connection()
+            cursor.execute(
+                """
+            SELECT stock_symbol, ts, open_price, high_price, low_price, price, volume
+            FROM price_history
+            WHERE stock_symbol = ? AND ts >= ?
+            ORDER BY ts ASC
+            """,
+                (symbol, changed_from),
+            )
+            rows = cursor.fetchall()
+            connection.close()
+
+            if rows:
+                notify_bars_stored(symbol, rows)
+                return
+
+        timeseries_store.invalidate(symbol)
+        chart_cache.invalidate(symbol)
+        live_updates.publish(symbol, "bars", [])
+
+    def follow_quote(self, symbol):
+        """Send the stored quote to clients streaming the symbol"""
+        if not live_updates.has_subscribers(symbol):
+            return
+
+        connection, cursor = create_connection()
+        cursor.execute(
+            """SELECT * FROM stocks_current WHERE stock_symbol = ?""", (symbol,)
+        )
+        row = cursor.fetchone()
+        connection.close()
+
+        if row:
+            live_updates.publish(symbol, "quote", dict(zip(QUOTE_KEYS, row)))
+
+
+# Shared watcher started by the web app
+version_watcher = VersionWatcher()
@@ -0,0 +1,162 @@
+# worker.py
+# Standalone ingest process: refreshes quotes and price history on a
+# schedule while the web processes only serve reads
+
+import os
+import socket
+import sqlite3
+from datetime import datetime
+from time import sleep, time
+from apscheduler.schedulers.background import BackgroundScheduler
+from database import (
+    create_connection,
+    create_tables,
+    update_current_stock_data,
+    sync_intraday_price_history,
+    update_all_portfolios,
+    LAZY_PORTFOLIO_VALUATION,
+)
+from setup import sync_daily_price_history
+from symbol_registry import get_due_symbols, get_tracked_symbols, REFRESH_TICK_SECONDS
+
+# Name of the lease row that decides which worker ingests
+LEASE_NAME = "ingest"
+
+# Seconds a lease stays valid without renewal; a standby worker takes over
+# this long after the ingesting one stops
+LEASE_SECONDS = 90
+
+# Seconds between lease renewals, and between takeover attempts on standby
+LEASE_RENEW_SECONDS = 15
+
+# Number of refresh ticks run so far, used to space out slower refresh tiers
+refresh_tick = 0
+
+
+def refresh_stock_data():
+    """Update stock data for the tracked symbols due on this tick"""
+    global refresh_tick
+    symbols = get_due_symbols(refresh_tick)
+    refresh_tick += 1
+
+    if symbols:
+        sync_intraday_price_history(symbols)
+        update_current_stock_data(symbols)
+
+    # Stored valuations are only needed when they are not computed on read
+    if not LAZY_PORTFOLIO_VALUATION:
+        revalued = update_all_portfolios()
+        print(f"Revalued {revalued} portfolio holdings")
+
+
+def refresh_daily_history():
+    """Update daily history for tracked symbols once the market has closed"""
+    sync_daily_price_history(get_tracked_symbols())
+
+
+def acquire_lease(owner):
+    """
+    Take or renew the ingest lease.
+
+    Succeeds when the lease is free, expired or already held by this owner.
+    The write lock of SQLite makes the check and the update atomic across
+    processes.
+
+    Args:
+        owner: Identifier of this worker process
+
+    Returns:
+        True if this worker holds the lease
+    """
+    now = int(time())
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(
+            """
+        INSERT INTO worker_leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE
+            SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE worker_leases.owner = excluded.owner
+            OR worker_leases.expires_at < ?
+        """,
+            (LEASE_NAME, owner, now + LEASE_SECONDS, now),
+        )
+        cursor.execute(
+            """SELECT owner FROM worker_leases WHERE name = ?""", (LEASE_NAME,)
+        )
+        holder = cursor.fetchone()[0]
+        connection.commit()
+        return holder == owner
+    except sqlite3.Error as e:
+        connection.rollback()
+        print(f"Error renewing ingest lease: {e}")
+        return False
+    finally:
+        connection.close()
+
+
+def release_lease(owner):
+    """Give up the ingest lease so a standby worker can take over at once"""
+    connection, cursor = create_connection(writer=True)
+    try:
+        cursor.execute(
+            """DELETE FROM worker_leases WHERE name = ? AND owner = ?""",
+            (LEASE_NAME, owner),
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def run_worker():
+    """
+    Run the ingest jobs while holding the lease, standing by otherwise.
+
+    Any number of workers can be started; the one holding the lease runs
+    the scheduled jobs and the others take over if it stops renewing.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    create_tables()
+
+    scheduler = BackgroundScheduler()
+    refresh_job = scheduler.add_job(
+        func=refresh_stock_data,
+        trigger="interval",
+        seconds=REFRESH_TICK_SECONDS,  # Update every minute
+        misfire_grace_time=30,
+    )
+    # Daily bars are published after the close, retry hourly until they arrive
+    scheduler.add_job(
+        func=refresh_daily_history,
+        trigger="cron",
+        day_of_week="mon-fri",
+        hour="16-20",
+        minute=30,
+        timezone="America/New_York",
+    )
+    scheduler.start(paused=True)
+
+    leading = False
+    try:
+        while True:
+            holds_lease = acquire_lease(owner)
+            if holds_lease and not leading:
+                print(f"Worker {owner} is ingesting")
+                # Catch up now instead of waiting for the first tick
+                scheduler.add_job(func=refresh_daily_history)
+                refresh_job.modify(next_run_time=datetime.now())
+                scheduler.resume()
+            elif leading and not holds_lease:
+                print(f"Worker {owner} lost the ingest lease, standing by")
+                scheduler.pause()
+            leading = holds_lease
+            sleep(LEASE_RENEW_SECONDS)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        scheduler.shutdown(wait=False)
+        release_lease(owner)
+
+
+if __name__ == "__main__":
+    run_worker()